@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''\
+Microbenchmarks for the FictionBook2 tools.
+
+Usage:
+     fb2bench.py [options] BENCHMARK [files]
+
+Benchmarks:
+     wordclass    word classification and transliteration in fb2fixtr.py
+                  (words are taken from the given text files)
+     base64       normalization of <binary> content in fb2format.py against
+                  decoding and encoding on the given FB2 files (by default
+                  on generated images)
+     binaries     fb2clean.py rules applied to the whole FB2 document
+                  against skipping the content of <binary> elements on
+                  the given files (by default on a generated book with
+                  images)
+     format       fb2format.py formatting of the DOM against the streaming
+                  formatter on the given FB2 files in all modes (fails if
+                  results differ)
+     header       fb2maketree.py reading of the book description with
+                  rescanning of the growing buffer against incremental
+                  scanning on the given FB2 files (by default on a
+                  generated book with a large cover in the description)
+     sync         fb2maketree.py making all trees anew against --sync of
+                  the trees after deleting one and rewriting another of
+                  the given FB2 files (by default of generated books;
+                  fails if the trees differ)
+
+Options:
+     -h, --help                   display this help message and exit
+     -V, --version                display the version and exit
+     -n N, --number N             repeat every measurement N times
+'''
+
+from __future__ import division, print_function, unicode_literals
+__author__ = 'Serhiy Storchaka <storchaka@users.sourceforge.net>'
+__version__ = '0.2'
+__all__ = []
+
+import sys, getopt, io, timeit, os, base64
+
+sample_words = ['сказал', 'Hello', 'noвод', 'ПPИBET', 'Глава1', '10кг', 'Mockba', '1990', 'I987', 'éte', 'кIт', 'сь1н']
+
+sample_fb2 = '''<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<description><title-info><date>2001-01-01</date></title-info><document-info><date value="2001-02-03">2001-02-03</date><id>1-2-3</id></document-info></description>
+<body><section><title><p>Глава 1</p></title><empty-line/>
+<p id="n1"/><p>- Ну... что? - сказал он.</p> <empty-line/> <p>* * *</p><subtitle></subtitle>
+<empty-line/>
+<p>1941-1945 <emphasis>годы </emphasis>- война<strong> -</strong></p>
+<p><emphasis></emphasis>- Да -</p><v>- Нет</v><subtitle>x x x</subtitle><empty-line/></section>
+<section><title><p>***</p></title><poem><stanza><v>строка - </v><v id="v1"/>
+<v>строка</v></stanza><date>1990-1991</date></poem></section></body>
+<binary id="i" content-type="image/png">AAAA</binary></FictionBook>
+'''
+
+def measure( func, words, number ):
+	'''Return the best time of func( word ) per word in microseconds.'''
+	best = None
+	for i in range( number ):
+		start = timeit.default_timer()
+		for word in words:
+			func( word )
+		t = timeit.default_timer() - start
+		if best is None or t < best:
+			best = t
+	return best / len( words ) * 1e6
+
+def report( name, old, new ):
+	print( '%-12s %8.3f us %8.3f us %6.2fx' % (name, old, new, old / new) )
+
+def bench_wordclass( files, number ):
+	import fb2fixtr
+
+	def regex_chain( word ):
+		# Цепочка проверок, которую заменил wordclass
+		if fb2fixtr.iscyr( word ) or fb2fixtr.islat( word ) or fb2fixtr.isnumber( word ):
+			return 'plain'
+		if fb2fixtr.ispseudo( word ):
+			return 'pseudo'
+		if fb2fixtr.ispseudorus( word ):
+			return 'pseudorus'
+		if fb2fixtr.ispseudolat( word ):
+			return 'pseudolat'
+		if fb2fixtr.hasdigits( word ):
+			return 'digits'
+		return None
+
+	def join_tocyr( word ):
+		return ''.join( fb2fixtr.lat2cyr[c] for c in word )
+
+	words = sample_words
+	if files:
+		words = []
+		for fname in files:
+			words.extend( fb2fixtr.word_re.findall( io.open( fname, 'rt', encoding = 'utf-8' ).read() ) )
+	for word in words:
+		assert regex_chain( word ) == fb2fixtr.wordclass( word ), word
+	pseudo = [word for word in words if fb2fixtr.ispseudocyr( word )] or ['ПPИBET']
+
+	print( '%-12s %11s %11s %7s' % ('', 'old', 'new', '') )
+	report( 'classify', measure( regex_chain, words, number ), measure( fb2fixtr.wordclass, words, number ) )
+	hard = [word for word in words if fb2fixtr.wordclass( word ) != 'plain'] or words
+	report( '  non-plain', measure( regex_chain, hard, number ), measure( fb2fixtr.wordclass, hard, number ) )
+	report( 'tocyr', measure( join_tocyr, pseudo, number ), measure( fb2fixtr.tocyr, pseudo, number ) )
+
+def bench_binaries( files, number ):
+	import fb2clean, xml_tokenizer
+
+	if files:
+		docs = []
+		for fname in files:
+			data = open( fname, 'rb' ).read()
+			docs.append( data.decode( xml_tokenizer.detect_encoding( data[:1 << 10] ) ) )
+	else:
+		binaries = []
+		for i in range( 20 ):
+			data = base64.encodebytes( os.urandom( 100000 ) ).decode( 'ascii' )
+			binaries.append( '<binary id="i%d" content-type="image/jpeg">%s</binary>\n' % (i, data) )
+		docs = [sample_fb2.replace( '</FictionBook>', ''.join( binaries ) + '</FictionBook>' )]
+	for data in docs:
+		assert fb2clean.apply_rules( data ) == fb2clean.convert( data )
+
+	print( '%-12s %11s %11s %7s' % ('', 'whole', 'skip', '') )
+	report( 'binaries', measure( fb2clean.apply_rules, docs, number ), measure( fb2clean.convert, docs, number ) )
+
+def bench_base64( files, number ):
+	import fb2format
+
+	def recode( data ):
+		return base64.b64encode( base64.b64decode( data ) )
+
+	if files:
+		binaries = []
+		for fname in files:
+			data = fb2format._spaces_re.sub( b' ', open( fname, 'rb' ).read() )
+			binaries.extend( m.group( 2 ).strip( b' ' ) for m in fb2format._binary_re.finditer( data ) )
+	else:
+		binaries = [base64.encodebytes( os.urandom( 100000 ) ).replace( b'\n', b' ' ) for i in range( 20 )]
+	for data in binaries:
+		assert fb2format._base64_normalize( data ) == recode( data )
+
+	print( '%-12s %11s %11s %7s' % ('', 'recode', 'check', '') )
+	report( 'base64', measure( recode, binaries, number ), measure( fb2format._base64_normalize, binaries, number ) )
+
+def bench_format( files, number ):
+	import fb2format, xml.dom.minidom, codecs
+
+	modes = [(False, False, False), (True, False, False), (True, True, False), (True, False, True)]
+
+	def dom( data, mode = (True, False, False) ):
+		format, squeeze, squeezeBinary = mode
+		doc = xml.dom.minidom.parse( io.BytesIO( data ) )
+		encoding = doc.encoding or str( 'utf-8' )
+		writer = codecs.getwriter( encoding )( io.BytesIO(), 'xmlcharrefreplace' )
+		doc.writexml( writer, encoding = encoding )
+		data = writer.getvalue()
+		if format:
+			data = fb2format.fb2format( data, squeeze = squeeze, squeezeBinary = squeezeBinary )
+		return data
+
+	def stream( data, mode = (True, False, False) ):
+		format, squeeze, squeezeBinary = mode
+		out = io.BytesIO()
+		fb2format.fb2format_stream( io.BytesIO( data ), out, None, format, squeeze, squeezeBinary )
+		return out.getvalue()
+
+	docs = [('sample', sample_fb2.encode( 'utf-8' ))]
+	for fname in files:
+		docs.append( (fname, open( fname, 'rb' ).read()) )
+	failed = 0
+	for name, data in docs:
+		for mode in modes:
+			if stream( data, mode ) != dom( data, mode ):
+				print( 'Results differ:', name, mode, file = sys.stderr )
+				failed += 1
+	if failed:
+		sys.exit( 1 )
+
+	docs = [data for name, data in docs]
+	print( '%-12s %11s %11s %7s' % ('', 'dom', 'stream', '') )
+	report( 'format', measure( dom, docs, number ), measure( stream, docs, number ) )
+
+def bench_header( files, number ):
+	import fb2maketree, re
+
+	xml_re = re.compile( br'<\?xml version="(?:[^">]*)" encoding="(?:[^">]*)"\?>', re.DOTALL )
+	desc_re = re.compile( br'<description>.*?</description>', re.DOTALL )
+
+	def rescan( data ):
+		# Loop which was replaced by read_description()
+		f = io.BytesIO( data )
+		data = b''
+		while True:
+			data += f.read( 1 << 13 )
+			try:
+				return xml_re.match( data ).group() + b'\n' + desc_re.search( data ).group()
+			except AttributeError:
+				continue
+
+	def incremental( data ):
+		return fb2maketree.read_description( io.BytesIO( data ) )
+
+	if files:
+		docs = [open( fname, 'rb' ).read() for fname in files]
+	else:
+		cover = base64.encodebytes( os.urandom( 1000000 ) ).decode( 'ascii' )
+		data = sample_fb2.replace( '<date>', '<coverpage><image l:href="#i"/></coverpage><annotation><p>%s</p></annotation><date>' % cover, 1 )
+		docs = [data.encode( 'utf-8' )]
+	for data in docs:
+		assert rescan( data ) == incremental( data )
+
+	print( '%-12s %11s %11s %7s' % ('', 'rescan', 'incremental', '') )
+	report( 'header', measure( rescan, docs, number ), measure( incremental, docs, number ) )
+
+def bench_sync( files, number ):
+	import tempfile, shutil, subprocess
+
+	def listing( root ):
+		# Relative path -> target of symbolic link or inode of hard link
+		result = {}
+		for dirpath, dirnames, filenames in os.walk( root ):
+			for name in filenames:
+				path = os.path.join( dirpath, name )
+				if os.path.islink( path ):
+					result[os.path.relpath( path, root )] = os.readlink( path )
+				else:
+					result[os.path.relpath( path, root )] = os.lstat( path ).st_ino
+		return result
+
+	def maketree( outputdir, books, *options ):
+		args = [sys.executable, 'fb2maketree.py', '-f', 'all', '-o', outputdir] + list( options ) + books
+		start = timeit.default_timer()
+		subprocess.check_call( args, cwd = os.path.dirname( os.path.abspath( __file__ ) ), stdout = devnull, stderr = devnull )
+		return timeit.default_timer() - start
+
+	tmpdir = tempfile.mkdtemp()
+	devnull = open( os.devnull, 'wb' )
+	try:
+		libdir = os.path.join( tmpdir, 'lib' )
+		os.mkdir( libdir )
+		books = []
+		if files:
+			for fname in files:
+				books.append( os.path.join( libdir, '%d.fb2' % len( books ) ) )
+				shutil.copyfile( fname, books[-1] )
+		else:
+			for i in range( 100 ):
+				info = ('<title-info><genre>prose</genre><author><first-name>A%d</first-name><last-name>B</last-name></author>'
+					'<book-title>T%d</book-title><lang>ru</lang><translator><last-name>C%d</last-name></translator>'
+					'<sequence name="S%d" number="%d"/>' % (i % 7, i % 30, i % 5, i % 3, i))
+				books.append( os.path.join( libdir, '%d.fb2' % i ) )
+				with open( books[-1], 'wb' ) as f:
+					f.write( sample_fb2.replace( '<title-info>', info, 1 ).encode( 'utf-8' ) )
+		synced = os.path.join( tmpdir, 'synced' )
+		maketree( synced, books )
+		# Deleted book
+		os.remove( books.pop( 0 ) )
+		# Rewritten book (the tools write a new file and rename it)
+		data = open( books[0], 'rb' ).read().replace( b'</body>', b'<p>-</p></body>', 1 )
+		with open( books[0] + '.tmp', 'wb' ) as f:
+			f.write( data )
+		os.rename( books[0] + '.tmp', books[0] )
+		anew = [maketree( os.path.join( tmpdir, 'anew%d' % i ), books ) for i in range( number )]
+		sync = [maketree( synced, books, '--sync' ) for i in range( number )]
+		if listing( synced ) != listing( os.path.join( tmpdir, 'anew0' ) ):
+			print( 'Results differ: sync', file = sys.stderr )
+			sys.exit( 1 )
+	finally:
+		devnull.close()
+		shutil.rmtree( tmpdir )
+
+	print( '%-12s %11s %11s %7s' % ('', 'anew', 'sync', '') )
+	report( 'sync', min( anew ) / len( books ) * 1e6, min( sync ) / len( books ) * 1e6 )
+
+benchmarks = {
+	'base64': bench_base64,
+	'binaries': bench_binaries,
+	'format': bench_format,
+	'header': bench_header,
+	'sync': bench_sync,
+	'wordclass': bench_wordclass,
+	}
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt( sys.argv[1:], 'hn:V', ['help', 'number=', 'version'] )
+	except getopt.GetoptError as err:
+		print( 'Error:', err, file = sys.stderr )
+		sys.exit( 2 )
+
+	number = 5
+
+	for option, value in opts:
+		if option in ('-h', '--help'):
+			sys.stdout.write( __doc__ )
+			sys.exit( 0 )
+		elif option in ('-V', '--version'):
+			print( __version__ )
+			sys.exit( 0 )
+		elif option in ('-n', '--number'):
+			number = int( value )
+
+	if not args or args[0] not in benchmarks:
+		sys.stdout.write( __doc__ )
+		sys.exit( 2 )
+
+	benchmarks[args[0]]( args[1:], number )
@@ -8,7 +8,10 @@ Usage:
 Options:
      -h, --help       display this help message and exit
      -V, --version    display the version and exit
+     -j N, --jobs N   process files in N parallel processes
      -k, --backup     create backup files
+     -r, --raw        convert the raw file content without rebuilding DOM
+                      (the file is left untouched if nothing is changed)
      -@ FILE          read file names from FILE (one name per line)
      -v, --progress   display progressbar
 
@@ -20,7 +23,8 @@ __version__ = '0.2'
 __all__ = []
 
 import re
-import sys, getopt, os, os.path, xml.dom.minidom, codecs, io
+import sys, getopt, os, os.path, xml.dom.minidom, xml.parsers.expat, codecs, io
+import xml_tokenizer
 
 fix_h2_re = re.compile( r'<h2 xmlns="">Taken: \w*, 1</h2>', re.UNICODE )
 # fix_style_re = re.compile( r'(<style name="\w*">)|(</style>)' )
@@ -68,7 +72,8 @@ def fix_ndash( data ):
 
 	return data
 
-def convert( data ):
+def apply_rules( data ):
+	'''Apply all rules to FB2 document.'''
 	# Remove <h2> elements
 	data = fix_h2_re.sub( '', data )
 # 	data = fix_style_re.sub( '', data )
@@ -102,23 +107,155 @@ def convert( data ):
 	data = empty_line_re.sub( '', data )
 	return data
 
+def split_binaries( data ):
+	'''Split out the content of <binary> elements.
+
+	Returns the list of pieces of data around the content and the list
+	of contents.
+	'''
+	pieces = []
+	binaries = []
+	pos = search = 0
+	while True:
+		start = data.find( '<binary', search )
+		if start < 0:
+			break
+		search = start = data.find( '>', start ) + 1
+		if not start:
+			break
+		if data[start - 2] == '/':
+			continue
+		end = data.find( '</binary>', start )
+		if end < 0:
+			break
+		pieces.append( data[pos:start] )
+		binaries.append( data[start:end] )
+		pos = search = end
+	pieces.append( data[pos:] )
+	return pieces, binaries
+
+def convert( data ):
+	'''Convert FB2 document.
+
+	No rule can match the base64 content of <binary> elements, so the
+	rules are applied to the document with the content removed, and the
+	content is put back untouched.
+	'''
+	pieces, binaries = split_binaries( data )
+	if not binaries:
+		return apply_rules( data )
+	# Rules never change the <binary> tags
+	pieces, empty = split_binaries( apply_rules( ''.join( pieces ) ) )
+	result = [pieces[0]]
+	for binary, piece in zip( binaries, pieces[1:] ):
+		result.append( binary )
+		result.append( piece )
+	return ''.join( result )
+
+def convert_raw( data ):
+	'''Convert raw content of FB2 file without building DOM.
+
+	Returns the converted content or None if nothing was changed.
+	Raises ExpatError if the result is not well-formed.
+	'''
+	encoding = xml_tokenizer.detect_encoding( data[:1 << 10] )
+	text0 = data.decode( encoding )
+	text = convert( text0 )
+	if text == text0:
+		return None
+	data = text.encode( encoding, 'xmlcharrefreplace' )
+	# Check well-formedness only, it is much cheaper than parsing to DOM
+	xml.parsers.expat.ParserCreate().Parse( data, True )
+	return data
+
 def writexml( doc, writer, encoding ):
 	writer = codecs.getwriter( encoding )( writer,  'xmlcharrefreplace' )
 	doc.writexml( writer, encoding = encoding )
 	writer.close()
 
 
+keepBackup = False
+backupSuffix = str( '.bak' )
+rawMode = False
+
+def process_file( filename ):
+	if rawMode:
+		if filename == str( '-' ):
+			if sys.version_info[0] >= 3:
+				f, out = sys.stdin.buffer, sys.stdout.buffer
+			else:
+				f, out = sys.stdin, sys.stdout
+			data0 = f.read()
+			data = convert_raw( data0 )
+			out.write( data0 if data is None else data )
+		else:
+			with open( filename, 'rb' ) as f:
+				data = convert_raw( f.read() )
+			if data is not None:
+				tmpfilename = filename + str( '.tmp' )
+				with open( tmpfilename, 'wb' ) as f:
+					f.write( data )
+				if keepBackup:
+					os.rename( filename, filename + backupSuffix )
+				os.rename( tmpfilename, filename )
+		return
+	if filename == str( '-' ):
+		if sys.version_info[0] >= 3:
+			f = sys.stdin.buffer.raw
+		else:
+			f = sys.stdin
+		doc = xml.dom.minidom.parse( f )
+	else:
+		doc = xml.dom.minidom.parse( open( filename, 'rb' ) )
+	encoding = doc.encoding or str( 'utf-8' )
+	data0 = doc.toxml( 'utf-8' ).decode( 'utf-8' )
+	data = convert( data0 )
+	if data != data0:
+		doc = xml.dom.minidom.parse( io.BytesIO( data.encode( 'utf-8' ) ) )
+		if filename == str( '-' ):
+			writexml( doc, sys.stdout, encoding )
+		else:
+			tmpfilename = filename + str( '.tmp' )
+			writexml( doc, open( tmpfilename, 'wb' ), encoding )
+			if keepBackup:
+				os.rename( filename, filename + backupSuffix )
+			os.rename( tmpfilename, filename )
+
+def init_worker( options ):
+	global keepBackup, rawMode
+	keepBackup, rawMode = options
+
+def process_file_job( job ):
+	index, filename = job
+	try:
+		process_file( filename )
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except Exception as err:
+		return index, str( err )
+	return index, None
+
+def file_size( filename ):
+	try:
+		return os.path.getsize( filename )
+	except OSError:
+		return 0
+
+def report_error( filename, err ):
+	print( str( 'Error processing "%s":' ) % filename, file = sys.stderr )
+	print( err, file = sys.stderr )
+
+
 if __name__ == '__main__':
 	try:
-		opts, args = getopt.getopt( sys.argv[1:], '@:hkqtvV',
-			['backup', 'help', 'progress', 'version'] )
+		opts, args = getopt.getopt( sys.argv[1:], '@:hj:kqrtvV',
+			['backup', 'help', 'jobs=', 'progress', 'raw', 'version'] )
 	except getopt.GetoptError as err:
 		print( 'Error:', err, file = sys.stderr )
 		sys.exit( 2 )
 
-	keepBackup = False
-	backupSuffix = str( '.bak' )
 	verbose = False
+	jobs = 1
 
 	for option, value in opts:
 		if option in ('-h', '--help'):
@@ -132,41 +269,50 @@ if __name__ == '__main__':
 				args.extend( line.rstrip( str( '\n' ) ) for line in sys.stdin )
 			else:
 				args.extend( line.rstrip( str( '\n' ) ) for line in open( value ) )
+		elif option in ('-j', '--jobs'):
+			jobs = int( value )
 		elif option in ('-k', '--backup'):
 			keepBackup = True
+		elif option in ('-r', '--raw'):
+			rawMode = True
 		elif option in ('-v', '--progress'):
 			verbose = True
 
+	if jobs > 1:
+		import multiprocessing
+		pool = multiprocessing.Pool( jobs, init_worker, ((keepBackup, rawMode),) )
+		# Standard input is processed by the main process
+		files = [filename for filename in args if filename != str( '-' )]
+		# Start with the largest files, so that they don't finish last
+		order = sorted( range( len( files ) ), key = lambda i: -file_size( files[i] ) )
+		results = pool.imap_unordered( process_file_job, [(i, files[i]) for i in order] )
+		errors = {}
+		index = 0
+	else:
+		pool = None
+
 	if verbose:
 		import progress_display
 		args = progress_display.progress_iter( args )
 
-	global filename
 	for filename in args:
+		if pool and filename != str( '-' ):
+			# Errors are reported in the order of files
+			while index not in errors:
+				i, err = next( results )
+				errors[i] = err
+			err = errors.pop( index )
+			index += 1
+			if err is not None:
+				report_error( filename, err )
+			continue
 		try:
-			if filename == str( '-' ):
-				if sys.version_info[0] >= 3:
-					f = sys.stdin.buffer.raw
-				else:
-					f = sys.stdin
-				doc = xml.dom.minidom.parse( f )
-			else:
-				doc = xml.dom.minidom.parse( open( filename, 'rb' ) )
-			encoding = doc.encoding or str( 'utf-8' )
-			data0 = doc.toxml( 'utf-8' ).decode( 'utf-8' )
-			data = convert( data0 )
-			if data != data0:
-				doc = xml.dom.minidom.parse( io.BytesIO( data.encode( 'utf-8' ) ) )
-				if filename == str( '-' ):
-					writexml( doc, sys.stdout, encoding )
-				else:
-					tmpfilename = filename + str( '.tmp' )
-					writexml( doc, open( tmpfilename, 'wb' ), encoding )
-					if keepBackup:
-						os.rename( filename, filename + backupSuffix )
-					os.rename( tmpfilename, filename )
+			process_file( filename )
 		except (KeyboardInterrupt, SystemExit):
 			raise
 		except Exception as err:
-			print( str( 'Error processing "%s":' ) % filename, file = sys.stderr )
-			print( err, file = sys.stderr )
+			report_error( filename, err )
+
+	if pool:
+		pool.close()
+		pool.join()
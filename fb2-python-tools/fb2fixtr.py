@@ -13,10 +13,27 @@ Options:
      -k, --backup                 create backup files
      -@ FILE                      read file names from FILE (one name per line)
      -q, --quick                  quick but use more memory
-     -T, --text                   process plain text
+     --quick-size N               quick, but remember at most N recently used
+                                  words (implies --quick)
+     -u, --vocabulary             fix every distinct word of a book only once
+     -p, --prescan                skip files which surely need no fixing
+                                  without parsing them
+     --check                      only list files which may need fixing
+     --stats FILE                 write hit counts and time of every fixing
+                                  rule per file to FILE in JSON
+     -j N, --jobs N               process files in N parallel processes
+     -T, --text                   process plain text in UTF-8 (in chunks)
+     -s, --stream                 use streaming parser instead of DOM (less memory)
      -v, --progress               display progressbar
      -o FILE, --log-file FILE     log all fixes to FILE
+     --log-format FORMAT          log format: plain (every occurrence, default),
+                                  summary, tsv or jsonl (distinct fixes of
+                                  every file with their counts)
      -d FILE, --dictionary FILE   use dictionary from FILE
+     -c FILE, --cache FILE        keep found translations in FILE between runs
+     --cache-size N               keep at most N translations in cache
+     --compile-dictionary FILE    save loaded dictionaries to FILE in compiled
+                                  form (it can be used with -d) and exit
 
 File name '-' means standard input.
 '''
@@ -27,7 +44,9 @@ __version__ = '0.2'
 __all__ = []
 
 import string, re
-import sys, getopt, os, os.path, xml.dom.minidom, codecs, io
+import sys, getopt, os, os.path, xml.dom.minidom, codecs, io, time, hashlib, struct
+import collections, json, timeit
+import xml_tokenizer
 
 quick = False
 
@@ -72,11 +91,28 @@ iscross = re.compile( r'\A[0-9]+(?:х[0-9]+)+\Z' ).match
 
 hasdigits = re.compile( r'\A.*[0-9].*\Z', re.UNICODE ).match
 
+# Классификация слова за один вызов вместо цепочки проверок iscyr, islat,
+# isnumber, ispseudo, ispseudorus, ispseudolat и hasdigits.
+# Альтернативы перечислены в том же порядке, в каком их проверяет fixtr_word.
+wordclass_re = re.compile( r'\A(?:'
+	r'(?P<plain>[' + cyr_letters + r'_]+|[' + string.ascii_letters + r'_]+|\d+)|'
+	r'(?P<pseudo>[' + cyr_lat_tr + cyr_tr + r']+)|'
+	r'(?P<pseudorus>[' + rus_letters + rus_lat_tr + r']+)|'
+	r'(?P<pseudolat>[' + string.ascii_letters + rus_tr + r']+)|'
+	r'(?P<digits>.*[0-9].*))\Z', re.UNICODE )
+
+def wordclass( word ):
+	m = wordclass_re.match( word )
+	return m and m.lastgroup
+
+lat2cyr_table = dict( (ord( c ), c2) for c, c2 in lat2cyr.items() )
+cyr2lat_table = dict( (ord( c ), c2) for c, c2 in cyr2lat.items() )
+
 def tocyr( word ):
-	return ''.join( lat2cyr[c] for c in word )
+	return word.translate( lat2cyr_table )
 
 def tolat( word ):
-	return ''.join( cyr2lat[c] for c in word )
+	return word.translate( cyr2lat_table )
 
 def readlist( fname ):
 	for line in io.open( fname, 'rt', encoding = 'utf-8' ):
@@ -84,7 +120,93 @@ def readlist( fname ):
 		if line and line[0] != '#':
 			yield line
 
-reserved_tr = set()
+class CompiledDictionary:
+	'''Dictionary compiled by --compile-dictionary.
+
+	The file contains sorted UTF-8 encoded words and the table of their
+	offsets.  It is memory mapped and words are looked up by binary search,
+	so loading takes no time and the memory is shared between processes.
+	'''
+	magic = b'FB2TRD1\n'
+	_header = struct.Struct( str( '<I20s' ) )
+	_offset = struct.Struct( str( '<II' ) )
+
+	def __init__( self, fname ):
+		import mmap
+		with open( fname, 'rb' ) as f:
+			self._data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+		if self._data[:len( self.magic )] != self.magic:
+			raise ValueError( 'Not a compiled dictionary: %s' % fname )
+		self._count, self.digest = self._header.unpack_from( self._data, len( self.magic ) )
+		self._offsets = len( self.magic ) + self._header.size
+		self._words = self._offsets + 4 * ( self._count + 1 )
+
+	def __len__( self ):
+		return self._count
+
+	def _word( self, i ):
+		start, end = self._offset.unpack_from( self._data, self._offsets + 4 * i )
+		return self._data[self._words + start:self._words + end]
+
+	def __contains__( self, word ):
+		word = word.encode( 'utf-8' )
+		lo, hi = 0, self._count
+		while lo < hi:
+			mid = ( lo + hi ) // 2
+			w = self._word( mid )
+			if w < word:
+				lo = mid + 1
+			elif w > word:
+				hi = mid
+			else:
+				return True
+		return False
+
+	def __iter__( self ):
+		for i in range( self._count ):
+			yield self._word( i ).decode( 'utf-8' )
+
+	@classmethod
+	def write( cls, fname, words ):
+		words = sorted( set( word.encode( 'utf-8' ) for word in words ) )
+		offsets = [0]
+		for word in words:
+			offsets.append( offsets[-1] + len( word ) )
+		data = b''.join( words )
+		with open( fname, 'wb' ) as f:
+			f.write( cls.magic )
+			f.write( cls._header.pack( len( words ), hashlib.sha1( data ).digest() ) )
+			f.write( struct.pack( str( '<%dI' % len( offsets ) ), *offsets ) )
+			f.write( data )
+
+class ReservedWords:
+	'''Set of words from plain text and compiled dictionaries.'''
+	def __init__( self ):
+		self.words = set()
+		self.compiled = []
+
+	def add( self, word ):
+		self.words.add( word )
+
+	def __contains__( self, word ):
+		if word in self.words:
+			return True
+		for d in self.compiled:
+			if word in d:
+				return True
+		return False
+
+	def __len__( self ):
+		return len( self.words ) + sum( len( d ) for d in self.compiled )
+
+	def __iter__( self ):
+		for word in self.words:
+			yield word
+		for d in self.compiled:
+			for word in d:
+				yield word
+
+reserved_tr = ReservedWords()
 def is_reserved_lat( word ):
 	return word in  reserved_tr and tocyr( word ) not in reserved_tr
 
@@ -101,13 +223,114 @@ try:
 except:
 	pass
 
+# Переводы, найденные при обработке текущего файла (в параллельном режиме
+# рабочий процесс возвращает их основному для слияния со словарём)
+learned = None
+# Слова, найденные в словаре (для вытеснения из постоянного кэша)
+used = None
+
+class TranslatesCache:
+	'''Persistent cache of fixtr_word results stored in SQLite database.
+
+	Entries are keyed by the rules digest, so the cache is invalidated
+	when the program or dictionaries change.  The least recently used
+	entries are evicted when the cache exceeds its size.
+	'''
+	def __init__( self, fname, rules, size = 1000000 ):
+		import sqlite3
+		self.rules = rules
+		self.size = size
+		# Ожидаем, пока кэш сохраняет другой процесс
+		self.db = sqlite3.connect( fname, timeout = 600, isolation_level = None )
+		self.db.execute( 'PRAGMA journal_mode = WAL' )
+		self.db.execute( 'CREATE TABLE IF NOT EXISTS translates ('
+			'rules TEXT NOT NULL, word TEXT NOT NULL, fix TEXT NOT NULL, used INTEGER NOT NULL, '
+			'PRIMARY KEY (rules, word))' )
+		self.db.execute( 'CREATE INDEX IF NOT EXISTS translates_used ON translates (used)' )
+
+	def load( self, unchanged = False, limit = None ):
+		'''Return (word, fix) pairs.  Unchanged words only if requested.
+
+		If limit is given, only so many most recently used pairs are
+		returned, from the least recently used.
+		'''
+		if limit is None:
+			return self.db.execute( 'SELECT word, fix FROM translates WHERE rules = ? AND (? OR word != fix)',
+				(self.rules, unchanged) )
+		return self.db.execute( 'SELECT word, fix FROM (SELECT word, fix, used FROM translates '
+			'WHERE rules = ? AND (? OR word != fix) ORDER BY used DESC LIMIT ?) ORDER BY used',
+			(self.rules, unchanged, limit) )
+
+	def save( self, learned, used ):
+		now = int( time.time() )
+		db = self.db
+		db.execute( 'BEGIN IMMEDIATE' )
+		try:
+			db.executemany( 'INSERT OR REPLACE INTO translates VALUES (?, ?, ?, ?)',
+				((self.rules, word, word2, now) for word, word2 in learned.items()) )
+			db.executemany( 'UPDATE translates SET used = ? WHERE rules = ? AND word = ?',
+				((now, self.rules, word) for word in used) )
+			count = db.execute( 'SELECT COUNT(*) FROM translates' ).fetchone()[0]
+			if count > self.size:
+				# Первыми вытесняются записи для других правил
+				db.execute( 'DELETE FROM translates WHERE rowid IN '
+					'(SELECT rowid FROM translates ORDER BY rules = ?, used LIMIT ?)',
+					(self.rules, count - self.size) )
+			db.execute( 'COMMIT' )
+		except:
+			db.execute( 'ROLLBACK' )
+			raise
+
+	def close( self ):
+		self.db.close()
+
+def rules_digest():
+	'''Return digest of everything fixtr_word results depend on.'''
+	h = hashlib.sha1( __version__.encode( 'utf-8' ) )
+	for word in sorted( reserved_tr.words ):
+		h.update( word.encode( 'utf-8' ) + b'\n' )
+	h.update( b'\0' )
+	for d in reserved_tr.compiled:
+		h.update( d.digest )
+	for word, word2 in sorted( translates.items() ):
+		h.update( word.encode( 'utf-8' ) + b' ' + word2.encode( 'utf-8' ) + b'\n' )
+	return h.hexdigest()
+
 logfile = None
+logformat = 'plain'
+# Счётчики различных исправлений текущего файла для сводного журнала
+log_buffer = collections.OrderedDict()
+
 global filename
 def logtr( word, type, *args ):
 	if logfile:
-		# hack for Python 2.x
-		fn = filename.decode( 'utf-8' ) if isinstance( filename, bytes ) else filename
-		print( '%s:' % fn, word, type, *args, file = logfile )
+		if logformat == 'plain':
+			# hack for Python 2.x
+			fn = filename.decode( 'utf-8' ) if isinstance( filename, bytes ) else filename
+			print( '%s:' % fn, word, type, *args, file = logfile )
+		else:
+			key = (word, type) + args
+			log_buffer[key] = log_buffer.get( key, 0 ) + 1
+
+def flush_log():
+	'''Write the summary log of the current file.'''
+	if not log_buffer:
+		return
+	# hack for Python 2.x
+	fn = filename.decode( 'utf-8' ) if isinstance( filename, bytes ) else filename
+	lines = []
+	for key, count in log_buffer.items():
+		word, type, args = key[0], key[1], key[2:]
+		if logformat == 'tsv':
+			lines.append( '\t'.join( (fn.replace( '\t', ' ' ), word, type, ' '.join( args ), str( count )) ) )
+		elif logformat == 'jsonl':
+			lines.append( json.dumps( {'file': fn, 'word': word, 'type': type, 'args': args, 'count': count},
+				ensure_ascii = False, sort_keys = True ) )
+		else:
+			lines.append( ' '.join( ('%s:' % fn, word, type) + args + ('x%d' % count,) ) )
+	lines.append( '' )
+	logfile.write( '\n'.join( lines ) )
+	log_buffer.clear()
 
 def tryconv( s, e1, e2 ):
 	try:
@@ -115,45 +338,68 @@ def tryconv( s, e1, e2 ):
 	except UnicodeEncodeError:
 		return None
 
+# Правила fixtr_word в порядке проверки.  Сработавшее правило fixtr_word
+# сохраняет в fixtr_rule.
+fixtr_rules = ('short', 'plain',
+	'pseudo-lat', 'pseudo-cyr', 'pseudo-fido-h', 'pseudo-ambiguous', 'pseudorus', 'pseudolat',
+	'digits-cross', 'digits-label', 'digits-chapter', 'digits-year', 'digits-end-unknown',
+	'digits-unit', 'digits-rus-suffix', 'digits-eng-suffix', 'digits-num2cyr', 'digits-begin-unknown',
+	'digits-ordinal', 'digits-y', 'digits-b', 'digits-unknown',
+	'european', 'pseudocyr-i', 'rus-jo', 'quote-left', 'quote-right', 'accent',
+	'cp1251-latin9', 'cp1251-latin9-ambiguous', 'unknown')
+fixtr_rule = None
+
 def fixtr_word( word ):
+	global fixtr_rule
 	# Слишком короткое слово -- гадать бессмысленно
 	if len( word ) < 3 or len( word.replace( '_', '' ) ) < 2:
+		fixtr_rule = 'short'
 		return word
 
+	cls = wordclass( word )
+
 	# Слово полностью принадлежит одном алфавиту
-	if iscyr( word ) or islat( word ) or isnumber( word ):
+	if cls == 'plain':
+		fixtr_rule = 'plain'
 		return word
 
 	# Слово состоит из букв, похожих и на русские (украинские) и на латиницу
-	if ispseudo( word ):
+	if cls == 'pseudo':
 		lat_word = tolat( word )
 		cyr_word = tocyr( word )
 		# Слово типично иноземное или римская цифра
 		if lat_word in  reserved_tr and cyr_word not in reserved_tr or isroman( lat_word ):
+			fixtr_rule = 'pseudo-lat'
 			return lat_word
 		# Слово типично кириллическое
 		if cyr_word in  reserved_tr and lat_word not in reserved_tr:
+			fixtr_rule = 'pseudo-cyr'
 			return cyr_word
 		# Только кириллическа 'Н' заменена на латинскую 'H' -- шуточки FIDO
 		if iscyr( word.replace( 'H', 'Н' ) ):
+			fixtr_rule = 'pseudo-fido-h'
 			return cyr_word
 
 		# Неопределённость
 		logtr( word, '?<>', lat_word, cyr_word )
+		fixtr_rule = 'pseudo-ambiguous'
 		return word
 
 	# Слово состоит из русских букв и похожих на русские
-	if ispseudorus( word ):
+	if cls == 'pseudorus':
+		fixtr_rule = 'pseudorus'
 		return tocyr( word )
 
 	# Слово состоит из латинских букв и похожих на латинские
-	if ispseudolat( word ):
+	if cls == 'pseudolat':
+		fixtr_rule = 'pseudolat'
 		return tolat( word )
 
 	# Слова с цифрами
-	if hasdigits( word ):
+	if cls == 'digits':
 		# Слова вида 9x12
 		if iscross( word ):
+			fixtr_rule = 'digits-cross'
 			return word
 
 		# Сначала буквы, потом цифры
@@ -161,17 +407,21 @@ def fixtr_word( word ):
 		if m and not hasdigits( m.group( 1 ) ):
 			# Метки часто содержат в себе номер
 			if m.group( 1 ) in (r'note', r'note_', r'Note', r'footnote', r'child_', r'FbAutId_', r'comment_', r'text_', r'N', r'N_', r'No'):
+				fixtr_rule = 'digits-label'
 				return word
 
 			# Между словом и номером пропущен пробел
 			if m.group( 1 ) in (r'Глава', r'ГЛАВА', r'глава'):
+				fixtr_rule = 'digits-chapter'
 				return m.expand( r'\1 \2' )
 
 			# Начальная единица года распозналась как 'I"
 			if re.match( r'\AI[89][0-9][0-9]\Z', word ):
+				fixtr_rule = 'digits-year'
 				return '1' + word[1:]
 			# Просто собираем статистику
 			logtr( word, '!' )
+			fixtr_rule = 'digits-end-unknown'
 			return word
 
 		# Сначала цифры, потом буквы
@@ -179,22 +429,28 @@ def fixtr_word( word ):
 		if m and not hasdigits( m.group( 2 ) ):
 			# Физические единицы отделяем неразрывным пробелом
 			if m.group( 2 ) in ('гг', 'мг', 'г', 'кг', 'мл', 'л', 'ч', 'мм', 'см', 'дм', 'м', 'км' ):
+				fixtr_rule = 'digits-unit'
 				return m.expand( '\\1\u00A0\\2' )
 			# Русские окончания отделяем дефисом
 			if m.group( 2 ) in ('ый', 'ой', 'й', 'ым', 'ом', 'я', 'ая', 'е', 'ое', 'го', 'ого', 'ю', 'ую'):
+				fixtr_rule = 'digits-rus-suffix'
 				return m.expand( r'\1-\2' )
 			# А английские оставляем так
 			if m.group( 2 ) in ('st', 'nd', 'rd', 'th', 's', 'd', 'ff', 'mm', 'cm', 'mm', 'km', 'unt', 'cc', 'F'):
+				fixtr_rule = 'digits-eng-suffix'
 				return word
 			if word[0] in '036' and ( iscyrlower( word[1:] ) or iscyrupper( word[1:] ) ):
+				fixtr_rule = 'digits-num2cyr'
 				return num2cyr[word[0]] + word[1:]
 			# Иначе просто собираем статистику
 			logtr( word, '!' )
+			fixtr_rule = 'digits-begin-unknown'
 			return word
 
 		# Начальная единица распозналась как 'I"
 		m = re.match( r'\AI[0-9]+(?:st|nd|rd|th|s|d)\Z', word )
 		if m:
+			fixtr_rule = 'digits-ordinal'
 			return '1' + word[1:]
 
 		# Возможно цифра -- на самом деле буква.
@@ -202,20 +458,24 @@ def fixtr_word( word ):
 		word2 = word.replace( 'ь1', 'ы' ).replace( 'Ь1', 'Ы' )
 		if word2 != word:
 			if ispseudorus( word2 ):
+				fixtr_rule = 'digits-y'
 				return tocyr( word2 )
 
 		if re.search( r'6[аеиоуaeuoy]|[аеиоуaeuoy]6', word ):
 			word2 = word.replace( '6', 'б' )
 			if ispseudorus( word2 ):
+				fixtr_rule = 'digits-b'
 				return tocyr( word2 )
 
 		logtr( word, '!' )
+		fixtr_rule = 'digits-unknown'
 		return word
 
 	# Слово принадлежит одному из европейских языков
 	for enc in ('iso-8859-2', 'iso-8859-4', 'iso-8859-7', 'iso-8859-15'):
 		try:
 			word.encode( enc )
+			fixtr_rule = 'european'
 			return word
 		except:
 			pass
@@ -232,21 +492,26 @@ def fixtr_word( word ):
 		word2 = re.sub( 'ii$', 'ії', word2 )
 		word2 = re.sub( 'II$', 'ІЇ', word2 )
 		word2 = tocyr( word2 )
+		fixtr_rule = 'pseudocyr-i'
 		return word2
 
 	# Слово состоит из русских букв и непонятного символа, похожего на J.
 	# На самом деле это 'ё'
 	if '\u0408' in word and isrusJ( word ) and word.replace( '\u0408', '' ):
+		fixtr_rule = 'rus-jo'
 		return word.replace( '\u0408', 'ё' )
 	# Слетевшая кодировка для кавычек-ёлочек
 	if word[0] == '\u0458' and isrus( word[1:] ):
+		fixtr_rule = 'quote-left'
 		return '\xab' + word[1:]
 	if word[-1] == '\u0405' and isrus( word[:-1] ):
+		fixtr_rule = 'quote-right'
 		return word[:-1] + '\xbb'
 
 	# Для обозначения ударения в русском слове использованы диакритические знаки.
 	for c in 'áéúóý':
 		if isrus( word.replace( c, '' ) ):
+			fixtr_rule = 'accent'
 			return word
 
 	# Возможно оригинальный текст был в европейской кодировке iso-8859-15,
@@ -257,11 +522,14 @@ def fixtr_word( word ):
 		# Если не-ASCII символов немного, то скорее всего так и есть
 		count = len( [c for c in word if c not in string.ascii_letters] )
 		if count <= 1 or 3 * count <= len( word ):
+			fixtr_rule = 'cp1251-latin9'
 			return word2
 		logtr( word, '?>', word2 )
+		fixtr_rule = 'cp1251-latin9-ambiguous'
 		return word
 
 	logtr( word, '!' )
+	fixtr_rule = 'unknown'
 	return word
 
 utf_illegal_pref_re = re.compile( '\u0432\u0402(?:\ufffd|[\u2000-\u203f])?', re.DOTALL )
@@ -272,33 +540,123 @@ def fix_utf_illegal_pref( m ):
 		return '\u2018'
 	return data.encode( 'cp1251' ).decode( 'utf-8' )
 
-def fixtr_text( text ):
-	global quick
-
-	changed = False
+def fixtr_chars( text ):
 	if '\u0432\u0402' in text: #'вЂ'
 		# Указана кодировка cp1251, а на самом деле -- utf-8
 		text = utf_illegal_pref_re.sub( fix_utf_illegal_pref, text )
-		changed = True
 
 	# Символы номера и копирайта, оставшиеся с HTML
 	text = text.replace( '&#x2116;', '\u2116' )
 	text = text.replace( '&#169;', '\xa9' )
+	return text
+
+# Ограниченный словарь для режима quick.  Слова из translates (загруженные
+# из replaces и reserved) никогда не вытесняются, а слова из кэша заносятся
+# сюда и вытесняются наравне с найденными.
+quick_cache = None
+quick_size = None
+translates_hits = translates_misses = translates_evictions = 0
+# Статистика правил fixtr_word: {имя файла: {правило: [число, время]}}
+rule_stats = None
+
+def write_rule_stats( fname ):
+	total = dict( (rule, [0, 0.0]) for rule in fixtr_rules )
+	files = {}
+	for fn, stats in rule_stats.items():
+		# hack for Python 2.x
+		fn = fn.decode( 'utf-8' ) if isinstance( fn, bytes ) else fn
+		files[fn] = dict( (rule, {'hits': n, 'time': t}) for rule, (n, t) in stats.items() )
+		for rule, (n, t) in stats.items():
+			total[rule][0] += n
+			total[rule][1] += t
+	data = {
+		'rules': dict( (rule, {'hits': n, 'time': t}) for rule, (n, t) in total.items() ),
+		'files': files,
+		}
+	with io.open( fname, 'wt', encoding = 'utf-8' ) as f:
+		f.write( json.dumps( data, indent = 1, sort_keys = True ) )
+		f.write( '\n' )
+
+def remember( word, word2 ):
+	global translates_evictions
+	if quick_cache is None:
+		translates[word] = word2
+	else:
+		quick_cache[word] = word2
+		if len( quick_cache ) > quick_size:
+			# Вытесняем давно не использованное слово
+			quick_cache.popitem( False )
+			translates_evictions += 1
+
+def translate_word( word ):
+	global translates_hits, translates_misses
+	# Для начала смотрим в словаре
+	if word in translates:
+		word2 = translates[word]
+		translates_hits += 1
+		if used is not None:
+			used.add( word )
+	elif quick_cache is not None and word in quick_cache:
+		word2 = quick_cache.pop( word )
+		quick_cache[word] = word2
+		translates_hits += 1
+		if used is not None:
+			used.add( word )
+	else:
+		translates_misses += 1
+		if rule_stats is None:
+			word2 = fixtr_word( word )
+		else:
+			start = timeit.default_timer()
+			word2 = fixtr_word( word )
+			stat = rule_stats.setdefault( filename, {} ).setdefault( fixtr_rule, [0, 0.0] )
+			stat[0] += 1
+			stat[1] += timeit.default_timer() - start
+		if quick or word != word2:
+			# Переведённое слово заносим в словарь.
+			# В режиме quick заносим и неизменённые слова, для ускорения.
+			remember( word, word2 )
+			if learned is not None:
+				learned[word] = word2
+	return word2
+
+# Исправления всех различных слов текущей книги и множество изменяемых слов
+vocabulary = {}
+vocabulary_changed = set()
+
+def collect_vocabulary( texts ):
+	'''Fix every distinct word of the book once, before fixing the texts.'''
+	global vocabulary, vocabulary_changed
+	vocabulary = {}
+	vocabulary_changed = set()
+	known = set()
+	for text in texts:
+		words = word_re.findall( fixtr_chars( text ) )
+		if known.issuperset( words ):
+			continue
+		for word in words:
+			if word not in vocabulary:
+				word2 = vocabulary[word] = translate_word( word )
+				if word2 != word:
+					vocabulary_changed.add( word )
+		known.update( words )
+
+def fixtr_text( text ):
+	text = fixtr_chars( text )
+	if vocabulary and vocabulary_changed.isdisjoint( word_re.findall( text ) ):
+		# Все слова текста уже проверены, исправлять нечего
+		return text
 
 	# Разбиваем текст на слова и обрабатываем их по отдельности.
 	# Потом склеиваем.
+	changed = False
 	words = word_re.split( text )
 	for iword, word in enumerate( words ):
 		if word_re.match( word ):
-			# Для начала смотрим в словаре
-			if word in translates:
-				word2 = translates[word]
+			if word in vocabulary:
+				word2 = vocabulary[word]
 			else:
-				word2 = fixtr_word( word )
-				if quick or word != word2:
-					# Переведённое слово заносим в словарь.
-					# В режиме quick заносим и неизменённые слова, для ускорения.
-					translates[word] = word2
+				word2 = translate_word( word )
 
 			if word != word2:
 				logtr( word, '->', word2 )
@@ -310,6 +668,9 @@ def fixtr_text( text ):
 
 	return text
 
+# Элементы, где исправлять текст бессмысленно и опасно
+skipped_tags = ('binary', 'id', 'email', 'src-url', 'program-used')
+
 def fixtr_fb2( node ):
 	changed = False
 	if node.nodeType == xml.dom.Node.TEXT_NODE:
@@ -317,17 +678,153 @@ def fixtr_fb2( node ):
 		if data != node.data:
 			node.data = data
 			changed = True
-	elif node.nodeType != xml.dom.Node.ELEMENT_NODE or node.tagName not in ('binary', 'id', 'email', 'src-url', 'program-used'):
+	elif node.nodeType != xml.dom.Node.ELEMENT_NODE or node.tagName not in skipped_tags:
 		# Рекурсивно обрабатываем элементы, кроме тех, где исправлять текст бессмысленно и опасно
 		for n in node.childNodes:
 			changed = fixtr_fb2( n ) or changed
 	return changed
 
+def text_chunks( f, size = 1 << 16 ):
+	'''Generate chunks of the text file f which end with whitespace.
+
+	Words and sequences fixed by fixtr_chars never cross the chunk
+	boundaries, so the chunks can be fixed independently.
+	'''
+	tail = ''
+	while True:
+		data = f.read( size )
+		if not data:
+			if tail:
+				yield tail
+			return
+		data = tail + data
+		i = max( data.rfind( ' ' ), data.rfind( '\n' ), data.rfind( '\t' ) ) + 1
+		if i:
+			yield data[:i]
+			tail = data[i:]
+		else:
+			tail = data
+
+def fixtr_text_stream( f, out ):
+	'''Fix plain text from file f chunk by chunk and write it to out.
+
+	Returns True if the text was changed.
+	'''
+	changed = False
+	for chunk in text_chunks( f ):
+		data = fixtr_text( chunk )
+		if data != chunk:
+			changed = True
+		out.write( data )
+	return changed
+
+def fb2_texts( node ):
+	'''Generate data of text nodes which fixtr_fb2 fixes.'''
+	if node.nodeType == xml.dom.Node.TEXT_NODE:
+		yield node.data
+	elif node.nodeType != xml.dom.Node.ELEMENT_NODE or node.tagName not in skipped_tags:
+		for n in node.childNodes:
+			for data in fb2_texts( n ):
+				yield data
+
+def stream_texts( f ):
+	'''Generate data of text nodes which fixtr_stream fixes.'''
+	head = f.read( 1 << 16 )
+	encoding = xml_tokenizer.detect_encoding( head )
+	read = xml_tokenizer.iterdecode( f, encoding, head )
+	for type, token in xml_tokenizer.tokenize( read, skipped_tags ):
+		if type == xml_tokenizer.TEXT:
+			yield xml_tokenizer.unescape( token )
+
+def fixtr_stream( f, out ):
+	'''Fix FB2 document from binary file f and write it to binary file out.
+
+	Unlike fixtr_fb2 does not build the document tree.  Only changed text
+	nodes are rewritten, everything else is copied byte-for-byte.
+	Returns True if the document was changed.
+	'''
+	head = f.read( 1 << 16 )
+	encoding = xml_tokenizer.detect_encoding( head )
+	encode = codecs.getincrementalencoder( encoding )( 'xmlcharrefreplace' ).encode
+	read = xml_tokenizer.iterdecode( f, encoding, head )
+	changed = False
+	for type, token in xml_tokenizer.tokenize( read, skipped_tags ):
+		if type == xml_tokenizer.TEXT:
+			data0 = xml_tokenizer.unescape( token )
+			data = fixtr_text( data0 )
+			if data != data0:
+				token = xml_tokenizer.escape( data )
+				changed = True
+		out.write( encode( token ) )
+	out.write( encode( '', True ) )
+	return changed
+
+# Элементы, в которых ничего не исправляется, и разметка
+prescan_skip_re = re.compile( br'<(' + '|'.join( skipped_tags ).encode( 'ascii' ) + br')(?:\s[^>]*)?(?<!/)>' )
+prescan_tag_re = re.compile( br'<[^>]*>' )
+prescan_re = None
+
+def make_prescan_re():
+	'''Make regex which finds everything what fixtr_text can change.'''
+	# Слова из одного алфавита, которые заменяются по словарю
+	plain_fixes = sorted( word for word, word2 in translates.items()
+		if word != word2 and wordclass( word ) == 'plain' )
+	return re.compile( '|'.join( [
+		# Смесь кириллицы и латиницы
+		'[' + cyr_letters + r']\w*?[' + string.ascii_letters + ']',
+		'[' + string.ascii_letters + r']\w*?[' + cyr_letters + ']',
+		# Смесь цифр и букв
+		r'\d\w*?[^\W\d]|[^\W\d]\w*?\d',
+		# Буквы других алфавитов
+		r'[^\W\d_' + string.ascii_letters + cyr_letters + ']',
+		# Исправляемые fixtr_chars последовательности
+		'\u0432\u0402', '&#x2116;', '&#169;',
+		] + [r'(?<!\w)' + re.escape( word ) + r'(?!\w)' for word in plain_fixes] ), re.UNICODE )
+
+def needs_fixing( data, text = False ):
+	'''Quickly check whether fixtr_text can change anything in raw data.
+
+	data is the content of the FB2 file, or the iterable of chunks
+	of plain text if text is true.
+	False positives are possible, false negatives are not.
+	'''
+	global prescan_re
+	if prescan_re is None:
+		prescan_re = make_prescan_re()
+	if text:
+		for chunk in data:
+			if prescan_re.search( chunk ):
+				return True
+		return False
+	encoding = xml_tokenizer.detect_encoding( data[:1 << 10] )
+	if codecs.lookup( encoding ).name.startswith( 'utf-16' ):
+		return True
+	# Пропускаем бинарные и прочие не исправляемые элементы
+	pieces = []
+	pos = 0
+	while True:
+		m = prescan_skip_re.search( data, pos )
+		if not m:
+			break
+		pieces.append( data[pos:m.start()] )
+		pos = data.find( b'</' + m.group( 1 ), m.end() )
+		if pos < 0:
+			pos = len( data )
+	pieces.append( data[pos:] )
+	data = prescan_tag_re.sub( b' ', b' '.join( pieces ) )
+	data = xml_tokenizer.unescape( data.decode( encoding, 'replace' ) )
+	return prescan_re.search( data ) is not None
+
 def update_trdict( word ):
 	if ispseudo( word ):
 		reserved_tr.add( word )
 
 def read_trdict( fname ):
+	with open( fname, 'rb' ) as f:
+		compiled = f.read( len( CompiledDictionary.magic ) ) == CompiledDictionary.magic
+	if compiled:
+		reserved_tr.compiled.append( CompiledDictionary( fname ) )
+		return
 	for word in readlist( fname ):
 		update_trdict( word )
 		tword = word[0].upper() + word[1:]
@@ -343,18 +840,203 @@ def writexml( doc, writer, encoding ):
 	writer.close()
 
 
+keepBackup = False
+backupSuffix = str( '.bak' )
+plainText = False
+stream = False
+bookVocabulary = False
+prescan = False
+checkOnly = False
+
+def process_file( fname ):
+	'''Fix the file.
+
+	Returns False if the file was skipped by prescan.  In check mode
+	only returns True if the file may need fixing.
+	'''
+	global filename, vocabulary
+	filename = fname
+	vocabulary = {}
+	# Стандартный ввод в режиме prescan приходится обрабатывать целиком,
+	# но в режиме check его достаточно просмотреть
+	if checkOnly or ( prescan and filename != str( '-' ) ):
+		if filename == str( '-' ):
+			if plainText:
+				if sys.version_info[0] >= 3:
+					f = sys.stdin
+				else:
+					f = codecs.getreader( 'utf-8' )( sys.stdin )
+				found = needs_fixing( text_chunks( f ), True )
+			elif sys.version_info[0] >= 3:
+				found = needs_fixing( sys.stdin.buffer.read() )
+			else:
+				found = needs_fixing( sys.stdin.read() )
+		elif plainText:
+			with io.open( filename, 'rt', encoding = 'utf-8' ) as f:
+				found = needs_fixing( text_chunks( f ), True )
+		else:
+			with open( filename, 'rb' ) as f:
+				found = needs_fixing( f.read() )
+		if not found:
+			return False
+		if checkOnly:
+			return True
+	if plainText:
+		# Process plain text in UTF-8
+		if filename == str( '-' ):
+			if sys.version_info[0] >= 3:
+				f, out = sys.stdin, sys.stdout
+			else:
+				f, out = codecs.getreader( 'utf-8' )( sys.stdin ), codecs.getwriter( 'utf-8' )( sys.stdout )
+			if bookVocabulary:
+				# Нужно прочитать текст дважды
+				f = io.StringIO( f.read() )
+				collect_vocabulary( text_chunks( f ) )
+				f.seek( 0 )
+			fixtr_text_stream( f, out )
+		else:
+			tmpfilename = filename + str( '.tmp' )
+			with io.open( filename, 'rt', encoding = 'utf-8' ) as f:
+				if bookVocabulary:
+					collect_vocabulary( text_chunks( f ) )
+					f.seek( 0 )
+				out = io.open( tmpfilename, 'wt', encoding = 'utf-8' )
+				try:
+					with out:
+						changed = fixtr_text_stream( f, out )
+				except:
+					os.remove( tmpfilename )
+					raise
+			if changed:
+				if keepBackup:
+					os.rename( filename, filename + backupSuffix )
+				os.rename( tmpfilename, filename )
+			else:
+				os.remove( tmpfilename )
+	else:
+		# Process FB2
+		if filename == str( '-' ) and stream:
+			if sys.version_info[0] >= 3:
+				f, out = sys.stdin.buffer, sys.stdout.buffer
+			else:
+				f, out = sys.stdin, sys.stdout
+			if bookVocabulary:
+				# Нужно прочитать текст дважды
+				f = io.BytesIO( f.read() )
+				collect_vocabulary( stream_texts( f ) )
+				f.seek( 0 )
+			fixtr_stream( f, out )
+		elif filename == str( '-' ):
+			if sys.version_info[0] >= 3:
+				f = sys.stdin.buffer.raw
+			else:
+				f = sys.stdin
+			doc = xml.dom.minidom.parse( f )
+			encoding = doc.encoding or str( 'utf-8' )
+			if bookVocabulary:
+				collect_vocabulary( fb2_texts( doc ) )
+			fixtr_fb2( doc )
+			if sys.version_info[0] >= 3:
+				f = sys.stdout.buffer.raw
+			else:
+				f = sys.stdout
+			writexml( doc, f, encoding )
+		elif stream:
+			tmpfilename = filename + str( '.tmp' )
+			with open( filename, 'rb' ) as f:
+				if bookVocabulary:
+					collect_vocabulary( stream_texts( f ) )
+					f.seek( 0 )
+				out = open( tmpfilename, 'wb' )
+				try:
+					with out:
+						changed = fixtr_stream( f, out )
+				except:
+					os.remove( tmpfilename )
+					raise
+			if changed:
+				if keepBackup:
+					os.rename( filename, filename + backupSuffix )
+				os.rename( tmpfilename, filename )
+			else:
+				os.remove( tmpfilename )
+		else:
+			doc = xml.dom.minidom.parse( open( filename, 'rb' ) )
+			encoding = doc.encoding or str( 'utf-8' )
+			if bookVocabulary:
+				collect_vocabulary( fb2_texts( doc ) )
+			if fixtr_fb2( doc ):
+				tmpfilename = filename + str( '.tmp' )
+				writexml( doc, open( tmpfilename, 'wb' ), encoding )
+				if keepBackup:
+					os.rename( filename, filename + backupSuffix )
+				os.rename( tmpfilename, filename )
+
+def init_worker( dictionaries, options ):
+	global keepBackup, plainText, stream, bookVocabulary, prescan, checkOnly
+	global quick, quick_size, quick_cache, logfile, logformat, used, rule_stats
+	keepBackup, plainText, stream, bookVocabulary, prescan, checkOnly, quick, quick_size, logging, logformat, caching, stats = options
+	rule_stats = {} if stats else None
+	logfile = io.StringIO() if logging else None
+	used = set() if caching else None
+	if quick_size and quick_cache is None:
+		quick_cache = collections.OrderedDict()
+	# При fork словари уже унаследованы от основного процесса
+	if not reserved_tr:
+		for fname in dictionaries:
+			read_trdict( fname )
+
+def process_file_job( fname ):
+	'''Process one file in a worker process.
+
+	Returns the result of process_file, the log for this file,
+	the error message (or None), the translations learned while
+	processing it, the set of used translations (if cache is used),
+	the dictionary statistics and the rule statistics.
+	'''
+	global learned, translates_hits, translates_misses, translates_evictions
+	translates_hits = translates_misses = translates_evictions = 0
+	if rule_stats is not None:
+		rule_stats.clear()
+	if logfile:
+		logfile.seek( 0 )
+		logfile.truncate()
+	learned = {}
+	if used is not None:
+		used.clear()
+	result = None
+	try:
+		result = process_file( fname )
+		error = None
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except Exception as err:
+		error = str( err )
+	if logfile:
+		flush_log()
+	return (result, logfile and logfile.getvalue(), error, learned, used,
+		(translates_hits, translates_misses, translates_evictions), rule_stats)
+
+def report_error( fname, err ):
+	print( str( 'Error processing "%s":' ) % fname, file = sys.stderr )
+	print( err, file = sys.stderr )
+
+
 if __name__ == '__main__':
 	try:
-		opts, args = getopt.getopt( sys.argv[1:], '@:d:hko:qTvV',
-			['backup', 'dictionary=', 'help', 'log-file', 'progress', 'quick', 'text', 'version'] )
+		opts, args = getopt.getopt( sys.argv[1:], '@:c:d:hj:ko:pqsTuvV',
+			['backup', 'cache=', 'cache-size=', 'check', 'compile-dictionary=', 'dictionary=', 'help', 'jobs=', 'log-file', 'log-format=', 'prescan', 'progress', 'quick', 'quick-size=', 'stats=', 'stream', 'text', 'version', 'vocabulary'] )
 	except getopt.GetoptError as err:
 		print( 'Error:', err, file = sys.stderr )
 		sys.exit( 2 )
 
-	keepBackup = False
-	backupSuffix = str( '.bak' )
 	verbose = False
-	plainText = False
+	jobs = 1
+	dictionaries = []
+	cache = None
+	cacheSize = 1000000
+	statsFile = None
+	compiledDictionary = None
 
 	for option, value in opts:
 		if option in ('-h', '--help'):
@@ -372,72 +1054,136 @@ if __name__ == '__main__':
 			keepBackup = True
 		elif option in ('-q', '--quick'):
 			quick = True
+		elif option == '--quick-size':
+			quick = True
+			quick_size = int( value )
+		elif option in ('-j', '--jobs'):
+			jobs = int( value )
 		elif option in ('-v', '--progress'):
 			verbose = True
 		elif option in ('-T', '--text'):
 			plainText = True
+		elif option in ('-s', '--stream'):
+			stream = True
+		elif option in ('-u', '--vocabulary'):
+			bookVocabulary = True
+		elif option in ('-p', '--prescan'):
+			prescan = True
+		elif option == '--check':
+			checkOnly = True
+		elif option == '--stats':
+			statsFile = value
+			rule_stats = {}
 		elif option in ('-o', '--log-file'):
 			logfile = io.open( value, 'wt', encoding = 'utf-8' )
+		elif option == '--log-format':
+			if value not in ('plain', 'summary', 'tsv', 'jsonl'):
+				print( 'Error: unknown log format:', value, file = sys.stderr )
+				sys.exit( 2 )
+			logformat = value
 		elif option in ('-d', '--dictionary'):
 			read_trdict( value )
+			dictionaries.append( value )
+		elif option in ('-c', '--cache'):
+			cache = value
+		elif option == '--cache-size':
+			cacheSize = int( value )
+		elif option == '--compile-dictionary':
+			compiledDictionary = value
+
+	if compiledDictionary:
+		CompiledDictionary.write( compiledDictionary, reserved_tr )
+		sys.exit( 0 )
+
+	if quick_size:
+		quick_cache = collections.OrderedDict()
+
+	if cache:
+		cache = TranslatesCache( cache, rules_digest(), cacheSize )
+		if quick_cache is None:
+			translates.update( cache.load( quick ) )
+		else:
+			# Загружаем не больше, чем поместится, начиная с давно не
+			# использованных
+			for word, word2 in cache.load( quick, quick_size ):
+				remember( word, word2 )
+		learned = {}
+		used = set()
+		# Накопленное сохраняется в кэш порциями, чтобы память оставалась
+		# ограниченной и в режиме quick
+		cacheBatch = quick_size or 10000
+
+	if jobs > 1:
+		import multiprocessing
+		args = list( args )
+		pool = multiprocessing.Pool( jobs, init_worker,
+			(dictionaries, (keepBackup, plainText, stream, bookVocabulary, prescan, checkOnly, quick, quick_size, bool( logfile ), logformat, bool( cache ), bool( statsFile ))) )
+		# Стандартный ввод обрабатывается основным процессом
+		results = pool.imap( process_file_job, [fname for fname in args if fname != str( '-' )] )
+		# Найденные рабочими процессами переводы нужны основному процессу
+		# только для стандартного ввода
+		merge = str( '-' ) in args
+	else:
+		pool = None
 
 	if verbose:
 		import progress_display
 		args = progress_display.progress_iter( args )
 
-	global filename
 	for filename in args:
-		try:
-			if plainText:
-				# Process plain text in UTF-8
-				if filename == str( '-' ):
-					if sys.version_info[0] >= 3:
-						data0 = sys.stdin.read()
-						data = fixtr_text( data0 )
-						sys.stdout.write( data )
-					else:
-						data0 = sys.stdin.read().decode( 'utf-8' )
-						data = fixtr_text( data0 )
-						sys.stdout.write( data.encode( 'utf-8' ) )
-				else:
-					data0 = io.open( filename, 'rt', encoding = 'utf-8' )
-					data = fixtr_text( data0 )
-					if data != data0:
-						tmpfilename = filename + str( '.tmp' )
-						io.open( tmpfilename, 'wt', encoding = 'utf-8' ).write( data )
-						if keepBackup:
-							os.rename( filename, filename + backupSuffix )
-						os.rename( tmpfilename, filename )
-			else:
-				# Process FB2
-				if filename == str( '-' ):
-					if sys.version_info[0] >= 3:
-						f = sys.stdin.buffer.raw
-					else:
-						f = sys.stdin
-					doc = xml.dom.minidom.parse( f )
-					encoding = doc.encoding or str( 'utf-8' )
-					fixtr_fb2( doc )
-					if sys.version_info[0] >= 3:
-						f = sys.stdout.buffer.raw
-					else:
-						f = sys.stdout
-					writexml( doc, f, encoding )
-				else:
-					doc = xml.dom.minidom.parse( open( filename, 'rb' ) )
-					encoding = doc.encoding or str( 'utf-8' )
-					if fixtr_fb2( doc ):
-						tmpfilename = filename + str( '.tmp' )
-						writexml( doc, open( tmpfilename, 'wb' ), encoding )
-						if keepBackup:
-							os.rename( filename, filename + backupSuffix )
-						os.rename( tmpfilename, filename )
-		except (KeyboardInterrupt, SystemExit):
-			raise
-		except Exception as err:
-			print( str( 'Error processing "%s":' ) % filename, file = sys.stderr )
-			print( err, file = sys.stderr )
-			raise
+		if pool and filename != str( '-' ):
+			# Результаты приходят в порядке следования файлов
+			result, log, error, words, words_used, stats, file_rule_stats = next( results )
+			if file_rule_stats:
+				rule_stats.update( file_rule_stats )
+			if merge:
+				for word, word2 in words.items():
+					remember( word, word2 )
+			translates_hits += stats[0]
+			translates_misses += stats[1]
+			translates_evictions += stats[2]
+			if cache:
+				learned.update( words )
+				used.update( words_used )
+			if log:
+				logfile.write( log )
+			if error is not None:
+				report_error( filename, error )
+				pool.terminate()
+				sys.exit( 1 )
+		else:
+			try:
+				result = process_file( filename )
+			except (KeyboardInterrupt, SystemExit):
+				raise
+			except Exception as err:
+				report_error( filename, err )
+				raise
+			finally:
+				if logfile:
+					flush_log()
+		if checkOnly and result:
+			print( filename )
+		if cache and len( learned ) + len( used ) > cacheBatch:
+			cache.save( learned, used )
+			learned.clear()
+			used.clear()
+
+	if pool:
+		pool.close()
+		pool.join()
+
+	if cache:
+		cache.save( learned, used )
+		cache.close()
+
+	if statsFile:
+		write_rule_stats( statsFile )
+
+	if quick:
+		print( 'Dictionary: %d hits, %d misses, %d evictions, %d words' %
+			(translates_hits, translates_misses, translates_evictions, len( translates ) + len( quick_cache or () )),
+			file = sys.stderr )
 
 	if logfile:
 		logfile.close()
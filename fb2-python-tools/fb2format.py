@@ -12,6 +12,7 @@ Options:
      -f, --format                      convert file to human readable format
      -s, --squeeze                     squeeze file in one line
      -b, --squeeze-binaries            squeeze binaries in one line
+     -S, --stream                      format file in one pass without building DOM
      -k, --backup                      create backup files
      -@ FILE                           read file names from FILE (one name per line)
      -v, --progress                    display progressbar
@@ -30,7 +31,8 @@ except:
 	pass
 
 import re, base64
-import sys, getopt, os, os.path, xml.dom.minidom, codecs, io
+import sys, getopt, os, os.path, xml.dom.minidom, xml.parsers.expat, codecs, io, filecmp
+import xml_tokenizer
 
 _spaces_re = re.compile( br'[ \t\r\n]{2,}|[\t\r\n]' )
 _empty_element_re = re.compile( br'<([^ >]+)([^>]*)(?<!/)></\1>' )
@@ -46,8 +48,27 @@ def _remove_eols( m ):
 def _binary_squeeze( m ):
 	return m.group( 1 ) + m.group( 2 ).replace( b' ', b'' ) + m.group( 3 )
 
+_base64_chars = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def _base64_normalize( data ):
+	'''Return base64 data in canonical form.
+
+	Usually the data differ from canonical form only by spaces, so it is
+	only checked, without decoding and encoding.
+	'''
+	stripped = data.replace( b' ', b'' )
+	if len( stripped ) % 4 == 0:
+		rest = stripped.translate( None, _base64_chars )
+		if not rest:
+			return stripped
+		# Unused bits of the last character must be zeros
+		if stripped.endswith( rest ) and (rest == b'=' and stripped[-2:-1] in b'AEIMQUYcgkosw048' or
+				rest == b'==' and stripped[-3:-2] in b'AQgw'):
+			return stripped
+	return base64.b64encode( base64.b64decode( data ) )
+
 def _binary_recode( m ):
-	return m.group( 1 ) + base64.b64encode( base64.b64decode( m.group( 2 ) ) ) + m.group( 3 )
+	return m.group( 1 ) + _base64_normalize( m.group( 2 ) ) + m.group( 3 )
 
 def _squeeze_tag( s ):
 	if _text_re.match( s ):
@@ -79,11 +100,254 @@ def fb2format( data, squeeze = False, squeezeBinary = False ):
 
 	return data
 
+_str_spaces_re = re.compile( r'[ \t\r\n]{2,}|[\t\r\n]' )
+_attribute_re = re.compile( r'''([^\s=]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''' )
+_pi_re = re.compile( r'<\?(\S+)\s*(.*)\?>', re.DOTALL )
+_declaration_re = re.compile( r'''<\?xml\s[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']''' )
+_text_tags = ('p', 'v', 'subtitle', 'text-author', 'th', 'td')
+_oneline_tags = ('title', 'author', 'translator')
+DECLARATION = 'declaration'
+
+def _serialize_tag( tag, empty ):
+	name = xml_tokenizer.tagname( tag )
+	attrs = _attribute_re.findall( tag, len( name ) + 1 )
+	# Namespace declarations go first
+	attrs = [attr for attr in attrs if attr[0].startswith( 'xmlns' )] + \
+		[attr for attr in attrs if not attr[0].startswith( 'xmlns' )]
+	result = ['<', name]
+	for attr, value1, value2 in attrs:
+		value = value1 or value2
+		for c in ('\r\n', '\r', '\n', '\t'):
+			value = value.replace( c, ' ' )
+		result.extend( (' ', attr, '="', xml_tokenizer.escape( xml_tokenizer.unescape( value ) ), '"') )
+	result.append( '/>' if empty else '>' )
+	return name, ''.join( result )
+
+def _minidom_tokens( tokens ):
+	'''Generate (type, name, text) tokens with text serialized as
+	xml.dom.minidom does.
+
+	The first token is (DECLARATION, encoding, None) with the encoding
+	declared in the document or None.
+	'''
+	declared = False
+	depth = 0
+	start = None
+	raw = []
+	for type, text in tokens:
+		if type == xml_tokenizer.RAW:
+			raw.append( text )
+			continue
+		if raw:
+			if start:
+				yield start
+				start = None
+			yield xml_tokenizer.TEXT, None, xml_tokenizer.escape( xml_tokenizer.unescape( ''.join( raw ) ) )
+			raw = []
+		if not declared:
+			if type == xml_tokenizer.TEXT:
+				# BOM or spaces
+				continue
+			declared = True
+			if type == xml_tokenizer.PI and xml_tokenizer.tagname( text ) == '?xml':
+				m = _declaration_re.match( text )
+				yield DECLARATION, m and m.group( 1 ), None
+				continue
+			yield DECLARATION, None, None
+		if type == xml_tokenizer.END:
+			name = xml_tokenizer.tagname( text )
+			depth -= 1
+			if start:
+				# Element without children
+				yield xml_tokenizer.EMPTY, name, start[2][:-1] + '/>'
+				start = None
+			else:
+				yield type, name, '</%s>' % name
+			continue
+		if start:
+			yield start
+			start = None
+		if type == xml_tokenizer.START:
+			depth += 1
+			name, tag = _serialize_tag( text, False )
+			start = type, name, tag
+		elif type == xml_tokenizer.EMPTY:
+			name, tag = _serialize_tag( text, True )
+			yield type, name, tag
+		elif type == xml_tokenizer.TEXT:
+			# Text outside of the root element is not kept
+			if depth:
+				yield type, None, xml_tokenizer.escape( xml_tokenizer.unescape( text ) )
+		elif type == xml_tokenizer.PI:
+			m = _pi_re.match( text )
+			yield type, m.group( 1 ), '<?%s %s?>' % m.groups()
+		else:
+			yield type, None, text
+	if start:
+		yield start
+
+class _Formatter( object ):
+	'''Apply fb2format() rules to serialized tokens one by one.'''
+	def __init__( self, write, encoding, squeeze, squeezeBinary ):
+		self.write = write
+		self.encoding = encoding
+		self.squeeze = squeeze
+		self.squeezeBinary = squeezeBinary
+		self.last = 'markup'    # kind of the last written piece
+		self.oneline = None     # element which is written in one line
+		self.element = None     # pieces of the current text element
+		self.span = None        # tokens of the text element which started
+		                        # with an empty tag
+		self.name = None
+		self.start = None       # start tag which can become empty tag
+
+	def emit( self, data, kind ):
+		if self.squeeze or self.oneline or data == '<title>':
+			sep = ''
+		elif self.last == 'element' or kind == 'element' or self.last == kind == 'markup':
+			sep = '\n'
+		else:
+			sep = ''
+		if self.oneline and not self.squeeze:
+			data = data.replace( '\n', '' )
+		self.write( sep + data )
+		self.last = kind
+
+	def flush_start( self ):
+		if self.start is not None:
+			self.emit( self.start, 'markup' )
+			if self.name in _oneline_tags and not self.oneline:
+				self.oneline = self.name
+			self.start = None
+
+	def feed( self, type, name, data, span = True ):
+		if self.span is not None:
+			self.span.append( (type, name, data) )
+		data = _str_spaces_re.sub( ' ', data )
+		if self.element is not None:
+			self.element.append( data )
+			if type == xml_tokenizer.END and name == self.name:
+				data = ''.join( self.element )
+				self.element = None
+				self.emit( data, 'element' )
+				if self.span is not None:
+					# Title or author can start or end inside
+					for type, name, data in self.span:
+						if type == xml_tokenizer.START and name in _oneline_tags and not self.oneline:
+							self.oneline = name
+						elif type == xml_tokenizer.END and name == self.oneline:
+							self.oneline = None
+					self.span = None
+		elif type == xml_tokenizer.EMPTY and span and name in _text_tags and data.startswith( '<%s ' % name ):
+			# fb2format() takes everything up to the next end tag of the
+			# same name for the text element
+			self.flush_start()
+			self.name = name
+			self.element = [data]
+			self.span = [(type, name, data)]
+		elif type == xml_tokenizer.START:
+			self.flush_start()
+			self.name = name
+			if name in _text_tags:
+				self.element = [data]
+			else:
+				self.start = data
+		elif type == xml_tokenizer.TEXT:
+			data = data.strip( ' ' )
+			if not data:
+				return
+			if self.start is not None and self.start.startswith( '<binary ' ):
+				if self.squeeze or self.squeezeBinary:
+					data = data.replace( ' ', '' )
+				else:
+					data = _base64_normalize( data.encode( self.encoding, 'xmlcharrefreplace' ) ).decode( 'ascii' )
+			self.flush_start()
+			self.emit( data, 'text' )
+		elif type == xml_tokenizer.END:
+			if self.start is not None and name == self.name:
+				# Element with spaces only
+				data = self.start[:-1] + '/>'
+				self.start = None
+			else:
+				self.flush_start()
+			self.emit( data, 'markup' )
+			if name == self.oneline:
+				self.oneline = None
+		else:
+			self.flush_start()
+			if type != xml_tokenizer.EMPTY:
+				data = data.replace( '> ', '>' ).replace( ' <', '<' )
+				if not self.squeeze:
+					data = data.replace( '><', '>\n<' ).replace( '>\n<title>', '><title>' )
+			self.emit( data, 'markup' )
+
+	def close( self ):
+		while self.span is not None:
+			# No end tag, format the tokens as usual
+			tokens = self.span
+			self.element = self.span = None
+			self.feed( *tokens[0], span = False )
+			for token in tokens[1:]:
+				self.feed( *token )
+		self.flush_start()
+
+class _CheckedReader( object ):
+	'''File wrapper which checks well-formedness of the read data.'''
+	def __init__( self, f ):
+		self.f = f
+		self.parser = xml.parsers.expat.ParserCreate()
+
+	def read( self, size ):
+		data = self.f.read( size )
+		self.parser.Parse( data, not data )
+		return data
+
+def fb2format_text( read, out, encoding = None, format = False, squeeze = False, squeezeBinary = False ):
+	'''Format well-formed FB2 document in one pass and write the result to out.
+
+	Text of the document is returned by read( size ).  The result is the
+	same as of writing the document parsed by xml.dom.minidom in the
+	given or declared encoding and applying fb2format() if format is true,
+	but the memory is bounded by the size of the largest text element or
+	binary.  As in fb2format(), a text element written as an empty tag
+	with attributes (<p id="x"/>) extends to the next end tag of the same
+	name.  Text elements should contain only inline markup, otherwise the
+	formatting can differ.
+	'''
+	tokens = _minidom_tokens( xml_tokenizer.tokenize( read, ('binary',) ) )
+	type, declared, data = next( tokens )
+	encoding = encoding or declared or str( 'utf-8' )
+	encoder = codecs.getincrementalencoder( encoding )( 'xmlcharrefreplace' )
+	def write( data ):
+		out.write( encoder.encode( data ) )
+	write( '<?xml version="1.0" encoding="%s"?>' % encoding )
+	if format:
+		if squeeze:
+			write( '\n' )
+		formatter = _Formatter( write, encoding, squeeze, squeezeBinary )
+		for type, name, data in tokens:
+			formatter.feed( type, name, data )
+		formatter.close()
+	else:
+		for type, name, data in tokens:
+			write( data )
+	out.write( encoder.encode( '', True ) )
+
+def fb2format_stream( f, out, encoding = None, format = False, squeeze = False, squeezeBinary = False ):
+	'''Format FB2 file f in one pass and write the result to out.
+
+	See fb2format_text().  Raises ExpatError if f is not well-formed.
+	'''
+	f = _CheckedReader( f )
+	head = f.read( 1 << 10 )
+	read = xml_tokenizer.iterdecode( f, xml_tokenizer.detect_encoding( head ), head )
+	fb2format_text( read, out, encoding, format, squeeze, squeezeBinary )
+
 
 if __name__ == '__main__':
 	try:
-		opts, args = getopt.getopt( sys.argv[1:], '@:be:fhksvV',
-			['backup', 'encoding=', 'format', 'help', 'progress', 'squeeze', 'squeeze-binaries', 'version'] )
+		opts, args = getopt.getopt( sys.argv[1:], '@:be:fhksSvV',
+			['backup', 'encoding=', 'format', 'help', 'progress', 'squeeze', 'squeeze-binaries', 'stream', 'version'] )
 	except getopt.GetoptError as err:
 		print( 'Error:', err, file = sys.stderr )
 		sys.exit( 2 )
@@ -92,6 +356,7 @@ if __name__ == '__main__':
 	format = False
 	squeeze = False
 	squeezeBinary = False
+	stream = False
 	keepBackup = False
 	backupSuffix = '.bak'
 	verbose = False
@@ -119,6 +384,8 @@ if __name__ == '__main__':
 			squeeze = True
 		elif option in ('-b', '--squeeze-binaries'):
 			squeezeBinary = True
+		elif option in ('-S', '--stream'):
+			stream = True
 		elif option in ('-v', '--progress'):
 			verbose = True
 
@@ -128,6 +395,29 @@ if __name__ == '__main__':
 
 	for filename in args:
 		try:
+			if stream:
+				if filename == str( '-' ):
+					if sys.version_info[0] >= 3:
+						fb2format_stream( sys.stdin.buffer, sys.stdout.buffer, forceEncoding, format, squeeze, squeezeBinary )
+					else:
+						fb2format_stream( sys.stdin, sys.stdout, forceEncoding, format, squeeze, squeezeBinary )
+				else:
+					tmpfilename = filename + str( '.tmp' )
+					with open( filename, 'rb' ) as f:
+						out = open( tmpfilename, 'wb' )
+						try:
+							with out:
+								fb2format_stream( f, out, forceEncoding, format, squeeze, squeezeBinary )
+						except:
+							os.remove( tmpfilename )
+							raise
+					if filecmp.cmp( filename, tmpfilename, False ):
+						os.remove( tmpfilename )
+					else:
+						if keepBackup:
+							os.rename( filename, filename + backupSuffix )
+						os.rename( tmpfilename, filename )
+				continue
 			if filename == str( '-' ):
 				if sys.version_info[0] >= 3:
 					f = sys.stdin.buffer.raw
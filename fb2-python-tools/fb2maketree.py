@@ -8,9 +8,20 @@ Usage:
 Options:
      -h, --help                   display this help message and exit
      -V, --version                display the version and exit
-     -f FORMAT, --format=FORMAT   use tree format (authors, authors-src, series, genres, translators, date)
+     -f FORMAT, --format=FORMAT   use tree format (authors, authors-src, series, genres, translators, date);
+                                  several comma separated formats or 'all' make
+                                  trees in subdirectories of DIR named by format
+                                  (every book is read only once)
      -o DIR, --output DIR         tree base directory
      -s, --symbolic               make symbolic links instead of hard links
+     --sync                       update existing tree: make only missing links
+                                  and remove links of books which are not given
+                                  (the tree is the same as if it was made anew)
+     -c FILE, --catalog FILE      keep parsed book descriptions in FILE between
+                                  runs (only new and changed books are read);
+                                  without fb2-files all books from the catalog
+                                  are used
+     -j N, --jobs N               read book descriptions in N parallel threads
      -@ FILE                      read file names from FILE (one name per line)
      -v, --progress               display progressbar
 
@@ -27,7 +38,7 @@ try:
 	psyco.full()
 except:
 	pass
-import sys, xml.etree.ElementTree, re, getopt, os, os.path, filecmp
+import sys, xml.etree.ElementTree, re, getopt, os, os.path, collections, json, hashlib, errno, stat
 
 filesystemencoding = sys.getfilesystemencoding()
 # filesystemencoding = 'utf-8'
@@ -37,47 +48,307 @@ def warn( tag, path ):
 		path = path.encode( filesystemencoding )
 	print( tag, path )
 
-def genname( dirname, filename, otherpath = None ):
-	filename = filename.replace( '"', "'" )
-	filename = filename.replace( ':', '.' )
-	for c in '+/<>\\|':
-		filename = filename.replace( c, '_' )
-	basename, suffix = os.path.splitext( filename )
+formats = ('authors', 'authors-src', 'series', 'genres', 'translators', 'date')
+
+class TreeCache:
+	'''Cached view of the output tree.
+
+	Every directory is listed at most once, and then the names of new
+	links and directories are added to the listing, so the file system
+	is touched only to make directories and links.  A virtual tree starts
+	empty and never touches the file system.
+	'''
+	def __init__( self, virtual = False ):
+		self.virtual = virtual
+		# dirname -> set of names, or None if the directory is not listed yet
+		self.dirs = {}
+
+	def names( self, dirname ):
+		names = self.dirs.get( dirname )
+		if names is None:
+			if self.virtual:
+				return set()
+			try:
+				if hasattr( os, 'scandir' ):
+					names = set( entry.name for entry in os.scandir( dirname ) )
+				else:
+					names = set( os.listdir( dirname ) )
+			except OSError:
+				names = set()
+			self.dirs[dirname] = names
+		return names
+
+	def add( self, path ):
+		dirname, name = os.path.split( path )
+		names = self.dirs.get( dirname )
+		if names is not None:
+			names.add( name )
+
+	def makedirs( self, dirname ):
+		'''Make directory and missing parents.'''
+		if dirname in self.dirs:
+			return
+		if self.virtual:
+			self.dirs[dirname] = set()
+			self.add( dirname )
+			return
+		try:
+			os.mkdir( dirname )
+		except OSError as err:
+			if err.errno == errno.EEXIST:
+				self.dirs[dirname] = None
+				return
+			parent = os.path.dirname( dirname )
+			if err.errno != errno.ENOENT or parent in ('', dirname):
+				raise
+			self.makedirs( parent )
+			os.mkdir( dirname )
+		self.dirs[dirname] = set()
+		self.add( dirname )
+
+tree = TreeCache()
+
+def makedirs( dirname ):
 	try:
-		if not os.path.exists( dirname ):
-			os.makedirs( dirname )
+		tree.makedirs( dirname )
 	except os.error as err:
 		print( err, file = sys.stderr )
 		pass
-	count = 0
-	path = os.path.join( dirname, filename )
-	while os.access( path, os.F_OK ):
+
+class DuplicateIndex:
+	'''Identities and content digests of files in the tree.
+
+	Files which can take the name of a new link are found once per run,
+	and every file is read at most once to compute its digest (digests
+	can be kept in the catalog between runs).
+	'''
+	def __init__( self, catalog = None ):
+		self.catalog = catalog
+		# (dirname, basename, suffix) -> [paths, unchecked paths, {identity: path}, {size: [(path, stat, file)]}]
+		self.groups = {}
+		self.digests = {}
+		self.stats = {}
+		# Sources of links made in this run
+		self.sources = {}
+		# Path -> book of links made in this run
+		self.books = {}
+		# digest -> equal books
+		self.duplicates = collections.OrderedDict()
+
+	def digest( self, path, st ):
+		identity = (st.st_dev, st.st_ino)
+		digest = self.digests.get( identity )
+		if digest is None:
+			if self.catalog:
+				digest = self.catalog.get_digest( st )
+			if digest is None:
+				h = hashlib.sha1()
+				with open( path, 'rb' ) as f:
+					for data in iter( lambda: f.read( 1 << 16 ), b'' ):
+						h.update( data )
+				digest = h.hexdigest()
+				if self.catalog:
+					self.catalog.set_digest( st, digest )
+			self.digests[identity] = digest
+		return digest
+
+	def group( self, dirname, basename, suffix ):
+		key = (dirname, basename, suffix)
+		group = self.groups.get( key )
+		if group is None:
+			group = self.groups[key] = [[], [], {}, {}]
+		paths, unchecked, identities, sizes = group
+		# The next names could be taken by links of other groups
+		names = tree.names( dirname )
+		while True:
+			if paths:
+				name = '%s__%d%s' % (basename, len( paths ), suffix)
+			else:
+				name = basename + suffix
+			if name not in names:
+				return group
+			path = os.path.join( dirname, name )
+			paths.append( path )
+			self.add( group, path, self.books.get( path ) )
+
+	def add( self, group, path, source ):
+		paths, unchecked, identities, sizes = group
+		if source:
+			st = self.stat( source )
+			identities.setdefault( (st.st_dev, st.st_ino), path )
+			sizes.setdefault( st.st_size, [] ).append( (path, st, source) )
+		else:
+			unchecked.append( path )
+
+	def stat( self, path ):
+		st = self.stats.get( path )
+		if st is None:
+			st = self.stats[path] = os.stat( path )
+		return st
+
+	def place( self, dirname, basename, suffix, otherpath = None, source = None ):
+		'''Return free name for the link to otherpath, or None if the tree
+		already has the same file or a file with the same content.
+
+		source is the book which the new link will refer to (otherpath by
+		default).
+		'''
+		group = self.group( dirname, basename, suffix )
+		paths, unchecked, identities, sizes = group
 		if otherpath:
-			if os.path.samefile( path, otherpath ):
-				return None
-			if filecmp.cmp( path, otherpath, 0 ):
-				warn( '#', path )
+			for path in unchecked:
+				try:
+					st = os.stat( path )
+				except OSError:
+					continue
+				identities[(st.st_dev, st.st_ino)] = path
+				sizes.setdefault( st.st_size, [] ).append( (path, st, path) )
+			del unchecked[:]
+			st = self.stat( otherpath )
+			identity = (st.st_dev, st.st_ino)
+			if identity in identities:
 				return None
-		count += 1
-		path = os.path.join( dirname, '%s__%d%s' % (basename, count, suffix) )
-	if count > 0:
-		warn( '!', path )
+			if st.st_size in sizes:
+				digest = self.digest( otherpath, st )
+				for path, st2, fname in sizes[st.st_size]:
+					if self.digest( fname, st2 ) == digest:
+						warn( '#', path )
+						books = self.duplicates.setdefault( digest, [] )
+						for book in (self.sources.get( (st2.st_dev, st2.st_ino), path ), otherpath):
+							if book not in books:
+								books.append( book )
+						return None
+			self.sources[identity] = otherpath
+		if paths:
+			path = os.path.join( dirname, '%s__%d%s' % (basename, len( paths ), suffix) )
+		else:
+			path = os.path.join( dirname, basename + suffix )
+		paths.append( path )
+		source = source or otherpath
+		self.add( group, path, source )
+		self.books[path] = source
+		return path
+
+index = DuplicateIndex()
+
+def genname( dirname, filename, otherpath = None, source = None ):
+	filename = filename.replace( '"', "'" )
+	filename = filename.replace( ':', '.' )
+	for c in '+/<>\\|':
+		filename = filename.replace( c, '_' )
+	basename, suffix = os.path.splitext( filename )
+	makedirs( dirname )
+	path = index.place( dirname, basename, suffix, otherpath, source )
+	if path:
+		tree.add( path )
+		if path != os.path.join( dirname, filename ):
+			warn( '!', path )
 	return path
 
+symbolic = False
+# Links of the synchronized tree: path -> (source, hard link)
+links = None
+
 def mklink( src, dst ):
-	try:
-		os.link( src, dst )
-	except OSError as err:
-		warn( '@', dst )
+	if links is not None:
+		links[dst] = (src, not symbolic)
+	elif symbolic:
+		os.symlink( src, dst )
+	else:
+		try:
+			os.link( src, dst )
+		except OSError as err:
+			warn( '@', dst )
+			os.symlink( src, dst )
+
+def symlink( src, dst ):
+	if links is not None:
+		links[dst] = (src, False)
+	else:
 		os.symlink( src, dst )
 
-def linkauthors( path, authornames, book_title ):
+def linkauthors( path, authornames, book_title, srcpath ):
 	if len( authornames ) > 1:
 		(dirname, filename) = os.path.split( path )
 		(basedir, dirname) = os.path.split( dirname )
 		mainname = os.path.join( '..', dirname, filename )
 		for authorname in authornames:
-			os.symlink( mainname, genname( os.path.join( basedir, authorname ), book_title + '.fb2' ) )
+			symlink( mainname, genname( os.path.join( basedir, authorname ), book_title + '.fb2', source = srcpath ) )
+
+def scantree( dirname ):
+	'''Generate (path, inode, is symlink) for FB2 files in the directory tree.'''
+	if hasattr( os, 'scandir' ):
+		try:
+			entries = list( os.scandir( dirname ) )
+		except OSError:
+			return
+		for entry in entries:
+			if entry.is_dir( follow_symlinks = False ):
+				for item in scantree( entry.path ):
+					yield item
+			elif entry.name.endswith( '.fb2' ):
+				yield entry.path, entry.inode(), entry.is_symlink()
+	else:
+		try:
+			names = os.listdir( dirname )
+		except OSError:
+			return
+		for name in names:
+			path = os.path.join( dirname, name )
+			st = os.lstat( path )
+			if stat.S_ISDIR( st.st_mode ):
+				for item in scantree( path ):
+					yield item
+			elif name.endswith( '.fb2' ):
+				yield path, st.st_ino, stat.S_ISLNK( st.st_mode )
+
+def synctree( links, dirnames ):
+	'''Make the trees in dirnames consist of the given links.
+
+	Only missing or wrong links are made, and FB2 files which are not in
+	links are removed together with emptied directories (hard links of
+	deleted or rewritten books are not distinguishable from other files,
+	so the books should not be inside dirnames).
+	Returns the numbers of made and removed links.
+	'''
+	tops = set( os.path.normpath( dirname ) for dirname in dirnames )
+	existing = {}
+	for dirname in dirnames:
+		for path, inode, islink in scantree( dirname ):
+			existing[path] = (inode, islink)
+	made = removed = 0
+	for path, (src, hard) in links.items():
+		if path in existing:
+			inode, islink = existing.pop( path )
+			if islink:
+				if os.readlink( path ) == src:
+					continue
+			elif hard and inode == index.stat( src ).st_ino:
+				continue
+			os.remove( path )
+		else:
+			makedirs( os.path.dirname( path ) )
+		if hard:
+			try:
+				os.link( src, path )
+			except OSError as err:
+				warn( '@', path )
+				os.symlink( src, path )
+		else:
+			os.symlink( src, path )
+		made += 1
+	for path in sorted( existing ):
+		os.remove( path )
+		warn( '-', path )
+		removed += 1
+		dirname = os.path.dirname( path )
+		while os.path.normpath( dirname ) not in tops:
+			try:
+				os.rmdir( dirname )
+			except OSError:
+				break
+			dirname = os.path.dirname( dirname )
+	return made, removed
 
 def getauthorname( author ):
 	first_name = author.findtext( 'first-name' )
@@ -89,18 +360,288 @@ def getauthorname( author ):
 		authorname += ' [%s]' % nickname
 	return authorname
 
-xml_re = re.compile( br'<\?xml version="(?:[^">]*)" encoding="(?:[^">]*)"\?>', re.DOTALL )
-desc_re = re.compile( br'<description>.*?</description>', re.DOTALL )
+xml_re = re.compile( br'(?:\xef\xbb\xbf)?\s*(<\?xml\s[^>]*\?>)' )
+desc_re = re.compile( br'<(description|body)[\s/>]' )
+desc_end = b'</description>'
+
+def read_description( f, chunk_size = 1 << 13 ):
+	'''Return XML declaration and <description> element of FB2 file f.
+
+	The file is read by chunks only up to the end of the description and
+	every chunk is scanned once.  Returns None if the file has no
+	description.
+	'''
+	data = bytearray()
+	pos = 0
+	start = None
+	while True:
+		chunk = f.read( chunk_size )
+		data += chunk
+		if start is None:
+			m = desc_re.search( data, pos )
+			if m:
+				if m.group( 1 ) != b'description':
+					# Description should be before the body
+					return None
+				start = m.start()
+				pos = m.end()
+			else:
+				pos = max( pos, len( data ) - len( b'<description ' ) )
+		if start is not None:
+			end = data.find( desc_end, pos )
+			if end >= 0:
+				break
+			pos = max( pos, len( data ) - len( desc_end ) + 1 )
+		if not chunk:
+			return None
+	m = xml_re.match( data, 0, start )
+	head = m.group( 1 ) + b'\n' if m else b''
+	return head + bytes( data[start:end + len( desc_end )] )
+
+Book = collections.namedtuple( 'Book', 'path authors translators title lang src_lang genres sequences date' )
+
+def read_book( srcpath ):
+	'''Read and parse the description of the book.'''
+	with open( srcpath, 'rb' ) as f:
+		doc = read_description( f )
+	if doc is None:
+		raise ValueError( 'no description' )
+	doc = doc.replace( b'xlink:href=', b'href=' ).replace( b'l:href=', b'href=' )
+
+	try:
+		description = xml.etree.ElementTree.fromstring( doc )
+	except:
+		print( doc )
+		raise
+
+	title_info = description.find( 'title-info' )
+
+	date = title_info.find( 'date' )
+	if date is not None:
+		date = (date.text, date.get( 'value' ))
+	return Book( srcpath,
+		[getauthorname( author ) for author in title_info.findall( 'author' )],
+		[getauthorname( author ) for author in title_info.findall( 'translator' )],
+		title_info.findtext( 'book-title' ),
+		title_info.findtext( 'lang' ),
+		title_info.findtext( 'src-lang' ),
+		[genre.text for genre in title_info.findall( 'genre' )],
+		[(sequence.get( 'name' ), sequence.get( 'number' ), sequence.get( 'src-name' )) for sequence in title_info.findall( 'sequence' )],
+		date )
+
+class Catalog:
+	'''Persistent catalog of book descriptions stored in SQLite database.
+
+	Entries are keyed by the file path and are valid while the size and
+	the modification time of the file are not changed.
+	'''
+	def __init__( self, fname ):
+		import sqlite3
+		self.db = sqlite3.connect( fname, timeout = 600 )
+		self.db.execute( 'CREATE TABLE IF NOT EXISTS books ('
+			'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+			'authors TEXT, translators TEXT, title TEXT, lang TEXT, src_lang TEXT, '
+			'genres TEXT, sequences TEXT, date TEXT)' )
+		self.db.execute( 'CREATE TABLE IF NOT EXISTS digests ('
+			'dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+			'digest TEXT NOT NULL, PRIMARY KEY (dev, ino))' )
+
+	def lookup( self, srcpath ):
+		'''Return (description, stat) of the book.  Description is None if
+		the book is new or changed.'''
+		st = os.stat( srcpath )
+		row = self.db.execute( 'SELECT size, mtime, authors, translators, title, lang, src_lang, '
+			'genres, sequences, date FROM books WHERE path = ?', (srcpath,) ).fetchone()
+		if row and row[0] == st.st_size and row[1] == st.st_mtime:
+			authors, translators, title, lang, src_lang, genres, sequences, date = row[2:]
+			date = json.loads( date )
+			return Book( srcpath, json.loads( authors ), json.loads( translators ), title, lang, src_lang,
+				json.loads( genres ), [tuple( sequence ) for sequence in json.loads( sequences )],
+				date and tuple( date ) ), st
+		return None, st
+
+	def store( self, book, st ):
+		self.db.execute( 'INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+			(book.path, st.st_size, st.st_mtime, json.dumps( book.authors ), json.dumps( book.translators ),
+			book.title, book.lang, book.src_lang, json.dumps( book.genres ),
+			json.dumps( book.sequences ), json.dumps( book.date )) )
+
+	def get( self, srcpath ):
+		'''Return description of the book, read it if it is new or changed.'''
+		book, st = self.lookup( srcpath )
+		if book is None:
+			book = read_book( srcpath )
+			self.store( book, st )
+		return book
+
+	def get_digest( self, st ):
+		row = self.db.execute( 'SELECT digest FROM digests WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?',
+			(st.st_dev, st.st_ino, st.st_size, st.st_mtime) ).fetchone()
+		return row and row[0]
+
+	def set_digest( self, st, digest ):
+		self.db.execute( 'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+			(st.st_dev, st.st_ino, st.st_size, st.st_mtime, digest) )
+
+	def paths( self ):
+		'''Return sorted paths of all books, forget removed files.'''
+		paths = []
+		removed = []
+		for (path,) in self.db.execute( 'SELECT path FROM books ORDER BY path' ):
+			if os.path.exists( path ):
+				paths.append( path )
+			else:
+				removed.append( (path,) )
+		self.db.executemany( 'DELETE FROM books WHERE path = ?', removed )
+		return paths
+
+	def close( self ):
+		self.db.commit()
+		self.db.close()
+
+class Result:
+	'''Result of the call made in the current thread (like AsyncResult).'''
+	def __init__( self, value = None, error = None ):
+		self.value = value
+		self.error = error
+
+	def wait( self ):
+		pass
+
+	def successful( self ):
+		return self.error is None
+
+	def get( self ):
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+def call( func, *args ):
+	try:
+		return Result( func( *args ) )
+	except Exception as err:
+		return Result( error = err )
+
+def read_books( names, catalog = None, pool = None, ahead = 0 ):
+	'''Generate (name, result) for every book in the given order.
+
+	result.get() returns the description of the book or raises the error
+	of reading it.  With the pool of threads up to ahead books are read
+	in advance.  The catalog is used only in the current thread.
+	'''
+	pending = collections.deque()
+	for name in names:
+		srcpath = os.path.abspath( name )
+		result = st = None
+		if catalog:
+			result = call( catalog.lookup, srcpath )
+			if result.successful():
+				book, st = result.get()
+				if book is not None:
+					# Not changed since the last run
+					result = Result( book )
+					st = None
+				else:
+					result = None
+		if result is None:
+			if pool:
+				result = pool.apply_async( read_book, (srcpath,) )
+			else:
+				result = call( read_book, srcpath )
+		pending.append( (name, st, result) )
+		while len( pending ) > ahead:
+			yield read_books_done( pending.popleft(), catalog )
+	while pending:
+		yield read_books_done( pending.popleft(), catalog )
+
+def read_books_done( item, catalog ):
+	name, st, result = item
+	if st:
+		# New or changed book
+		result.wait()
+		if result.successful():
+			catalog.store( result.get(), st )
+	return name, result
+
+def place_book( book, format, outputdir ):
+	'''Link the book into the tree of the given format.'''
+	srcpath = book.path
+	authornames = book.authors
+	translatornames = book.translators
+	book_title = book.title
+	lang = book.lang
+	src_lang = book.src_lang
+
+	if len( authornames ) > 4:
+		authornames_str = ', '.join( authornames[:4] ) + ',..'
+	else:
+		authornames_str = ', '.join( authornames )
+
+	if len( book_title ) > 120:
+		book_title = book_title[:120] + '...'
+
+	if format == 'authors':
+		basedir = os.path.join( outputdir, lang )
+		path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
+		if path:
+			mklink( srcpath, path )
+			linkauthors( path, authornames, book_title, srcpath )
+	elif format == 'authors-src':
+		basedir = os.path.join( outputdir, src_lang or lang )
+		path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
+		if path:
+			mklink( srcpath, path )
+			linkauthors( path, authornames, book_title, srcpath )
+	elif format == 'series':
+		for sequence_name, sequence_number, sequence_src_name in book.sequences:
+			dirname = sequence_name or '-'
+			if sequence_src_name:
+				dirname += ' [%s]' % sequence_src_name
+			dirname += ' : ' + authornames_str
+			filename = book_title + '.fb2'
+			if sequence_number:
+				filename = sequence_number + '. ' + filename
+			path = genname( os.path.join( outputdir, lang, dirname[:120] ), filename, srcpath )
+			if path:
+				mklink( srcpath, path )
+	elif format == 'genres':
+		for genre in book.genres or ('?'):
+			basedir = os.path.join( outputdir, lang, genre )
+			path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
+			if path:
+				mklink( srcpath, path )
+				linkauthors( path, authornames, book_title, srcpath )
+	elif format == 'translators':
+		basedir = outputdir
+		if not translatornames and lang != src_lang:
+			translatornames = ('?')
+		for authorname in translatornames:
+			mklink( srcpath, genname( os.path.join( basedir, authorname ), ( authornames_str + '. ' + book_title )[:120] + '.fb2', source = srcpath ) )
+	elif format == 'date':
+		date_str = None
+		if book.date is not None:
+			date_text, date_value = book.date
+			date_str = date_text or '?'
+			if date_value:
+				date_str += ' [%s]' % date_value
+		date_str = date_str or '?'
+		basedir = os.path.join( outputdir, date_str )
+		path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
+		if path:
+			mklink( srcpath, path )
 
 if __name__ == '__main__':
 	try:
-		opts, args = getopt.getopt( sys.argv[1:], '@:hf:o:svV', ['help', 'format=', 'output=', 'symbolic', 'version', 'progress'] )
+		opts, args = getopt.getopt( sys.argv[1:], '@:c:hf:j:o:svV', ['catalog=', 'help', 'format=', 'jobs=', 'output=', 'symbolic', 'sync', 'version', 'progress'] )
 	except getopt.GetoptError as err:
 		print( 'Error:', err, file = sys.stderr )
 		sys.exit( 2 )
 	outputdir = '.'
 	verbose = False
-	format = None
+	formatlist = []
+	catalog = None
+	sync = False
+	jobs = 1
 	for option, value in opts:
 		if option in ('-h', '--help'):
 			sys.stdout.write( __doc__ )
@@ -116,110 +657,93 @@ if __name__ == '__main__':
 		elif option in ('-v', '--progress'):
 			verbose = True
 		elif option in ('-f', '--format'):
-			format = value
+			for format in value.split( ',' ):
+				if format == 'all':
+					formatlist.extend( formats )
+				elif format in formats:
+					formatlist.append( format )
+				else:
+					print( 'Error: unknown format', format, file = sys.stderr )
+					sys.exit( 2 )
 		elif option in ('-o', '--output'):
 			outputdir = value
 		elif option in ('-s', '--symbolic'):
-			mklink = os.symlink
+			symbolic = True
+		elif option == '--sync':
+			sync = True
+		elif option in ('-j', '--jobs'):
+			jobs = int( value )
+		elif option in ('-c', '--catalog'):
+			catalog = value
+
+	formatlist = [format for i, format in enumerate( formatlist ) if format not in formatlist[:i]]
+	if len( formatlist ) > 1:
+		outputdirs = [(format, os.path.join( outputdir, format )) for format in formatlist]
+	else:
+		outputdirs = [(format, outputdir) for format in formatlist]
+	if sync:
+		# Make the tree anew in memory and then apply the difference
+		realtree = tree
+		tree = TreeCache( True )
+		links = collections.OrderedDict()
+	for format, dirname in outputdirs:
+		makedirs( dirname )
+
+	if catalog:
+		catalog = Catalog( catalog )
+		index.catalog = catalog
+		if not args:
+			args = catalog.paths()
+
+	if sync:
+		# The books should not be taken for stale links
+		tops = [os.path.join( os.path.realpath( dirname ), '' ) for format, dirname in outputdirs]
+		for fb2name in args:
+			srcpath = os.path.join( os.path.realpath( fb2name ), '' )
+			if any( srcpath.startswith( top ) for top in tops ):
+				print( 'Error: --sync with book "%s" inside the output directory' % fb2name, file = sys.stderr )
+				sys.exit( 2 )
 
 	if verbose:
 		import progress_display
 		args = progress_display.progress_iter( args )
 
-	for fb2name in args:
-		srcpath = os.path.abspath( fb2name )
-		#if verbose:
-		#	print( fb2name )
-		try:
-			with open( srcpath, 'rb' ) as f:
-				data = b''
-				while True:
-					data += f.read( 1 << 13 )
-					try:
-						doc = xml_re.match( data ).group() + b'\n' + desc_re.search( data ).group()
-					except AttributeError:
-						continue
-					break
-			doc = doc.replace( b'xlink:href=', b'href=' ).replace( b'l:href=', b'href=' )
+	pool = None
+	if jobs > 1:
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool( jobs )
 
+	try:
+		for fb2name, result in read_books( args, catalog, pool, jobs * 8 ):
+			#if verbose:
+			#	print( fb2name )
 			try:
-				description = xml.etree.ElementTree.fromstring( doc )
-			except:
-				print( doc )
+				book = result.get()
+				for format, dirname in outputdirs:
+					place_book( book, format, dirname )
+			except (KeyboardInterrupt, SystemExit):
 				raise
+			except Exception as err:
+				print( str( 'Error processing "%s":' ) % fb2name, file = sys.stderr )
+				print( err, file = sys.stderr )
+				sys.exit( 1 )
+	finally:
+		if pool:
+			pool.terminate()
+		if catalog:
+			catalog.close()
 
-			title_info = description.find( 'title-info' )
+	if sync:
+		tree = realtree
+		newlinks, links = links, None
+		for format, dirname in outputdirs:
+			makedirs( dirname )
+		made, removed = synctree( newlinks, [dirname for format, dirname in outputdirs] )
+		print( 'Made %d links, removed %d links' % (made, removed) )
 
-			authornames = [getauthorname( author ) for author in title_info.findall( 'author' )]
-			translatornames = [getauthorname( author ) for author in title_info.findall( 'translator' )]
-
-			book_title = title_info.findtext( 'book-title' )
-			lang = title_info.findtext( 'lang' )
-			src_lang = title_info.findtext( 'src-lang' )
-
-			genres = [genre.text for genre in title_info.findall( 'genre' )]
-			sequences = [(sequence.get( 'name' ), sequence.get( 'number' ), sequence.get( 'src-name' )) for sequence in title_info.findall( 'sequence' )]
-
-
-			if len( authornames ) > 4:
-				authornames_str = ', '.join( authornames[:4] ) + ',..'
-			else:
-				authornames_str = ', '.join( authornames )
-
-			if len( book_title ) > 120:
-				book_title = book_title[:120] + '...'
-
-			if format == 'authors':
-				basedir = os.path.join( outputdir, lang )
-				path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
-				if path:
-					mklink( srcpath, path )
-					linkauthors( path, authornames, book_title )
-			elif format == 'authors-src':
-				basedir = os.path.join( outputdir, src_lang or lang )
-				path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
-				if path:
-					mklink( srcpath, path )
-					linkauthors( path, authornames, book_title )
-			elif format == 'series':
-				for sequence_name, sequence_number, sequence_src_name in sequences:
-					dirname = sequence_name or '-'
-					if sequence_src_name:
-						dirname += ' [%s]' % sequence_src_name
-					dirname += ' : ' + authornames_str
-					filename = book_title + '.fb2'
-					if sequence_number:
-						filename = sequence_number + '. ' + filename
-					path = genname( os.path.join( outputdir, lang, dirname[:120] ), filename, srcpath )
-					if path:
-						mklink( srcpath, path )
-			elif format == 'genres':
-				for genre in genres or ('?'):
-					basedir = os.path.join( outputdir, lang, genre )
-					path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
-					if path:
-						mklink( srcpath, path )
-						linkauthors( path, authornames, book_title )
-			elif format == 'translators':
-				basedir = outputdir
-				if not translatornames and lang != src_lang:
-					translatornames = ('?')
-				for authorname in translatornames:
-					mklink( srcpath, genname( os.path.join( basedir, authorname ), ( authornames_str + '. ' + book_title )[:120] + '.fb2' ) )
-			elif format == 'date':
-				date = title_info.find( 'date' )
-				if date is not None:
-					date_str = date.text or '?'
-					if date.get( 'value' ):
-						date_str += ' [%s]' % date.get( 'value' )
-				date_str = date_str or '?'
-				basedir = os.path.join( outputdir, date_str )
-				path = genname( os.path.join( basedir, authornames_str ), book_title + '.fb2', srcpath )
-				if path:
-					mklink( srcpath, path )
-		except (KeyboardInterrupt, SystemExit):
-			raise
-		except Exception as err:
-			print( str( 'Error processing "%s":' ) % fb2name, file = sys.stderr )
-			print( err, file = sys.stderr )
-			sys.exit( 1 )
+	if index.duplicates:
+		print( 'Duplicates:' )
+		for books in index.duplicates.values():
+			print()
+			for book in books:
+				warn( '=', book )
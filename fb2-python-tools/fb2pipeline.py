@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''\
+Fix, clean and format FictionBook2 files.
+
+Does the same as running fb2fixtr.py, fb2clean.py and fb2format.py -f
+one after another, but every file is parsed and written only once.
+
+Usage:
+     fb2pipeline.py [options] [fb2-files]
+
+Options:
+     -h, --help                        display this help message and exit
+     -V, --version                     display the version and exit
+     -d FILE, --dictionary FILE        use dictionary from FILE for fixing
+     -q, --quick                       quick fixing but use more memory
+     -e ENCODING, -encoding ENCODING   output in the given encoding
+     -s, --squeeze                     squeeze file in one line instead of
+                                       formatting
+     -b, --squeeze-binaries            squeeze binaries in one line
+     -k, --backup                      create backup files
+     -t, --timing                      display time spent in every stage
+     -@ FILE                           read file names from FILE (one name per line)
+     -v, --progress                    display progressbar
+
+File name '-' means standard input.
+'''
+
+from __future__ import division, print_function, unicode_literals
+__author__ = 'Serhiy Storchaka <storchaka@users.sourceforge.net>'
+__version__ = '0.2'
+__all__ = ['process', 'stages']
+
+import sys, getopt, os, os.path, xml.dom.minidom, xml.parsers.expat, io, timeit
+import fb2fixtr, fb2clean, fb2format
+
+stages = ('parse', 'fix', 'clean', 'format')
+
+def process( data, encoding = None, squeeze = False, squeezeBinary = False, timing = None ):
+	'''Fix, clean and format FB2 document.
+
+	data is the content of the file.  Returns the result encoded in the
+	given or declared encoding.  If timing is a dict, the time spent in
+	every stage is added to it.
+	'''
+	times = [timeit.default_timer()]
+	doc = xml.dom.minidom.parse( io.BytesIO( data ) )
+	encoding = encoding or doc.encoding or str( 'utf-8' )
+	times.append( timeit.default_timer() )
+
+	fb2fixtr.fixtr_fb2( doc )
+	times.append( timeit.default_timer() )
+
+	text0 = doc.toxml()
+	doc.unlink()
+	text = fb2clean.convert( text0 )
+	if text != text0:
+		# The rules can break markup
+		xml.parsers.expat.ParserCreate().Parse( text.encode( 'utf-8' ), True )
+	times.append( timeit.default_timer() )
+
+	out = io.BytesIO()
+	fb2format.fb2format_text( io.StringIO( text ).read, out, encoding, True, squeeze, squeezeBinary )
+	times.append( timeit.default_timer() )
+
+	if timing is not None:
+		for stage, start, end in zip( stages, times, times[1:] ):
+			timing[stage] = timing.get( stage, 0 ) + end - start
+	return out.getvalue()
+
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt( sys.argv[1:], '@:bd:e:hkqstvV',
+			['backup', 'dictionary=', 'encoding=', 'help', 'progress', 'quick', 'squeeze', 'squeeze-binaries', 'timing', 'version'] )
+	except getopt.GetoptError as err:
+		print( 'Error:', err, file = sys.stderr )
+		sys.exit( 2 )
+
+	forceEncoding = None
+	squeeze = False
+	squeezeBinary = False
+	keepBackup = False
+	backupSuffix = str( '.bak' )
+	timing = None
+	verbose = False
+
+	for option, value in opts:
+		if option in ('-h', '--help'):
+			sys.stdout.write( __doc__ )
+			sys.exit( 0 )
+		elif option in ('-V', '--version'):
+			print( __version__ )
+			sys.exit( 0 )
+		elif option == '-@':
+			if value == '-':
+				args.extend( line.rstrip( str( '\n' ) ) for line in sys.stdin )
+			else:
+				args.extend( line.rstrip( str( '\n' ) ) for line in open( value ) )
+		elif option in ('-d', '--dictionary'):
+			fb2fixtr.read_trdict( value )
+		elif option in ('-q', '--quick'):
+			fb2fixtr.quick = True
+		elif option in ('-e', '--encoding'):
+			forceEncoding = value
+		elif option in ('-s', '--squeeze'):
+			squeeze = True
+		elif option in ('-b', '--squeeze-binaries'):
+			squeezeBinary = True
+		elif option in ('-k', '--backup'):
+			keepBackup = True
+		elif option in ('-t', '--timing'):
+			timing = {}
+		elif option in ('-v', '--progress'):
+			verbose = True
+
+	if verbose:
+		import progress_display
+		args = progress_display.progress_iter( args )
+
+	for filename in args:
+		try:
+			fb2fixtr.filename = filename
+			if filename == str( '-' ):
+				if sys.version_info[0] >= 3:
+					f, out = sys.stdin.buffer, sys.stdout.buffer
+				else:
+					f, out = sys.stdin, sys.stdout
+				out.write( process( f.read(), forceEncoding, squeeze, squeezeBinary, timing ) )
+			else:
+				with open( filename, 'rb' ) as f:
+					data0 = f.read()
+				data = process( data0, forceEncoding, squeeze, squeezeBinary, timing )
+				if data != data0:
+					tmpfilename = filename + str( '.tmp' )
+					with open( tmpfilename, 'wb' ) as f:
+						f.write( data )
+					if keepBackup:
+						os.rename( filename, filename + backupSuffix )
+					os.rename( tmpfilename, filename )
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except Exception as err:
+			print( str( 'Error processing "%s":' ) % filename, file = sys.stderr )
+			print( err, file = sys.stderr )
+
+	if timing is not None:
+		for stage in stages:
+			print( '%-8s %8.3f s' % (stage, timing.get( stage, 0 )), file = sys.stderr )
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''\
+Simple streaming XML tokenizer.
+
+Splits XML text into markup and character data without building a tree.
+Every token keeps its source text verbatim, so joining all tokens gives
+back the input exactly.
+'''
+from __future__ import division, print_function, unicode_literals
+import re, codecs
+
+TEXT = 'text'           # character data (with entity references)
+START = 'start'         # start tag
+END = 'end'             # end tag
+EMPTY = 'empty'         # empty-element tag
+RAW = 'raw'             # content of raw element, may come in several pieces
+COMMENT = 'comment'
+CDATA = 'cdata'
+PI = 'pi'               # processing instruction or XML declaration
+DOCTYPE = 'doctype'
+
+_tag_re = re.compile( r'<[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>' )
+_tagname_re = re.compile( r'</?([^\s/>]+)' )
+_doctype_re = re.compile( r'<!DOCTYPE[^>\[]*(?:\[[^\]]*\][^>]*)?>' )
+_encoding_re = re.compile( br'\A(?:\xef\xbb\xbf)?<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']' )
+
+def tagname( tag ):
+	'''Return the element name of the start, end or empty tag.'''
+	return _tagname_re.match( tag ).group( 1 )
+
+def detect_encoding( head ):
+	'''Detect encoding of the XML document by its first bytes.'''
+	if head.startswith( (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE) ):
+		return 'utf-16'
+	m = _encoding_re.match( head )
+	if m:
+		return m.group( 1 ).decode( 'ascii' )
+	return 'utf-8'
+
+_markup_ends = (
+	('<!--', '-->', COMMENT),
+	('<![CDATA[', ']]>', CDATA),
+	('<?', '?>', PI),
+	)
+
+def tokenize( read, raw_elements = (), chunk_size = 1 << 16 ):
+	'''Generate (type, text) tokens from the text returned by read( size ).
+
+	Content of elements named in raw_elements is not tokenized and is
+	yielded as RAW pieces.  Memory is bounded by the size of the largest
+	markup or text token, not by the size of the document.
+	'''
+	buf = ''
+	pos = 0
+	eof = False
+	raw_end = None
+	while True:
+		if pos and pos >= len( buf ) >> 1:
+			buf = buf[pos:]
+			pos = 0
+		if raw_end:
+			# Copy the content of raw element until its end tag
+			i = buf.find( raw_end, pos )
+			if i < 0:
+				if eof:
+					if pos < len( buf ):
+						yield RAW, buf[pos:]
+					return
+				# Keep the tail which can be start of the end tag
+				keep = max( pos, len( buf ) - len( raw_end ) + 1 )
+				if keep > pos:
+					yield RAW, buf[pos:keep]
+					pos = keep
+			else:
+				if i > pos:
+					yield RAW, buf[pos:i]
+				pos = i
+				raw_end = None
+				continue
+		elif pos < len( buf ):
+			if buf[pos] != '<':
+				i = buf.find( '<', pos )
+				if i >= 0:
+					yield TEXT, buf[pos:i]
+					pos = i
+					continue
+				if eof:
+					yield TEXT, buf[pos:]
+					return
+			else:
+				token = None
+				for start, end, type in _markup_ends:
+					if buf.startswith( start, pos ):
+						i = buf.find( end, pos + len( start ) )
+						if i >= 0:
+							token = type, buf[pos:i + len( end )]
+						break
+					if start.startswith( buf[pos:pos + len( start )] ) and not eof:
+						# Not enough data to decide
+						break
+				else:
+					if buf.startswith( '<!DOCTYPE', pos ):
+						m = _doctype_re.match( buf, pos )
+						if m:
+							token = DOCTYPE, m.group()
+					else:
+						m = _tag_re.match( buf, pos )
+						if m:
+							tag = m.group()
+							if tag[1] == '/':
+								token = END, tag
+							elif tag[-2] == '/':
+								token = EMPTY, tag
+							else:
+								token = START, tag
+								name = tagname( tag )
+								if name in raw_elements:
+									raw_end = '</' + name
+				if token:
+					yield token
+					pos += len( token[1] )
+					continue
+				if eof:
+					# Unterminated markup
+					yield TEXT, buf[pos:]
+					return
+		elif eof:
+			return
+		data = read( chunk_size )
+		if data:
+			buf += data
+		else:
+			eof = True
+
+def iterdecode( f, encoding, head = b'' ):
+	'''Return read( size ) function for decoding binary file f.
+
+	head is the data already read from the start of the file.
+	'''
+	decoder = codecs.getincrementaldecoder( encoding )()
+	pending = [head] if head else []
+	def read( size ):
+		while True:
+			data = pending.pop() if pending else f.read( size )
+			text = decoder.decode( data, not data )
+			if text or not data:
+				return text
+	return read
+
+try:
+	_unichr = unichr
+except NameError:
+	_unichr = chr
+
+_entity_re = re.compile( r'&(?:#([0-9]+)|#x([0-9a-fA-F]+)|(amp|lt|gt|quot|apos));' )
+_entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+def _unescape_entity( m ):
+	if m.group( 1 ):
+		return _unichr( int( m.group( 1 ) ) )
+	if m.group( 2 ):
+		return _unichr( int( m.group( 2 ), 16 ) )
+	return _entities[m.group( 3 )]
+
+def unescape( text ):
+	'''Return character data of the TEXT token as parser sees it.'''
+	if '\r' in text:
+		text = text.replace( '\r\n', '\n' ).replace( '\r', '\n' )
+	if '&' in text:
+		text = _entity_re.sub( _unescape_entity, text )
+	return text
+
+def escape( text ):
+	'''Escape character data the same way as xml.dom.minidom does.'''
+	return text.replace( '&', '&amp;' ).replace( '<', '&lt;' ).replace( '"', '&quot;' ).replace( '>', '&gt;' )